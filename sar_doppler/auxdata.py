@@ -0,0 +1,236 @@
+''' Local read-through cache of auxiliary model fields (GlobCurrent, NCEP)
+
+Model files found in the directories of settings.SAR_DOPPLER_AUX_SOURCES are
+indexed by variable and time. A field requested on a target grid or swath
+geometry is read and reprojected once, and then kept both in memory (for
+reuse across the subswaths of a scene) and on disk (for reuse across runs).
+'''
+import os
+import re
+import bisect
+import datetime
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from nansat.nansat import Nansat
+
+from sar_doppler.cache import LRUCache, DiskCache, cache_dir, key_digest
+
+# Each source is a directory with files named according to pattern. The
+# pattern has the named groups year, month and day, and optionally hour,
+# forecast (hours added to the time) and variable. If variable is not in the
+# pattern, the file contains all the listed variables (standard names).
+DEFAULT_SOURCES = [
+    {
+        'directory': '/vagrant/shared/test_data/globcurrent',
+        'pattern': r'(?P<variable>\w+?)_(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})\.nc$',
+        'mapper': 'generic',
+    },
+    {
+        'directory': '/mnt/10.11.12.231/sat_auxdata/model/ncep/gfs',
+        'pattern': r'gfs(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})/gfs\.t(?P<hour>\d{2})z\.master\.grbf(?P<forecast>\d{2})$',
+        'variables': ['eastward_wind', 'northward_wind'],
+        'mapper': 'ncep',
+    },
+]
+
+MEMORY_CACHE_SIZE = 512*1024**2
+DISK_CACHE_SIZE = 10*1024**3
+
+class TimeIndex(object):
+    ''' Sorted index of items by time, with O(log n) nearest and bracketing
+    lookups
+    '''
+
+    def __init__(self, entries=()):
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.times = [entry[0] for entry in entries]
+        self.items = [entry[1] for entry in entries]
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, time, item):
+        i = bisect.bisect_right(self.times, time)
+        self.times.insert(i, time)
+        self.items.insert(i, item)
+
+    def nearest(self, time, tolerance=None):
+        ''' Return (time, item) nearest to time, or None if there is none
+        within the tolerance (a timedelta)
+        '''
+        i = bisect.bisect_left(self.times, time)
+        candidates = [j for j in (i-1, i) if 0 <= j < len(self.times)]
+        if not candidates:
+            return None
+        j = min(candidates, key=lambda j: abs(self.times[j] - time))
+        if tolerance is not None and abs(self.times[j] - time) > tolerance:
+            return None
+        return self.times[j], self.items[j]
+
+    def bracket(self, time):
+        ''' Return ((t0, item0), (t1, item1)) with t0 <= time <= t1, or None if
+        time is outside the index
+        '''
+        i = bisect.bisect_left(self.times, time)
+        if i < len(self.times) and self.times[i] == time:
+            return (self.times[i], self.items[i]), (self.times[i], self.items[i])
+        if i == 0 or i == len(self.times):
+            return None
+        return (self.times[i-1], self.items[i-1]), (self.times[i], self.items[i])
+
+def target_key(domain):
+    ''' Return a key identifying the grid or swath geometry of a Domain (or
+    Nansat) object
+    '''
+    ds = domain.vrt.dataset
+    gcps = tuple((g.GCPPixel, g.GCPLine, round(g.GCPX, 6), round(g.GCPY, 6))
+            for g in ds.GetGCPs())
+    return key_digest((ds.GetProjection() or ds.GetGCPProjection(),
+        tuple(ds.GetGeoTransform()), domain.shape(), gcps))
+
+class AuxiliaryIndex(object):
+    ''' Index of local auxiliary model files by variable and time
+
+    The source directories are scanned lazily, on the first lookup of a
+    variable they may hold: the sources listing the variable, and the sources
+    with the variable in the file names, whose variables are only known once
+    scanned.
+    '''
+
+    def __init__(self, sources=None):
+        if sources is None:
+            sources = getattr(settings, 'SAR_DOPPLER_AUX_SOURCES',
+                    DEFAULT_SOURCES)
+        self.sources = sources
+        self._lock = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        ''' Clear the index, so the source directories are scanned again '''
+        with self._lock:
+            self._index = {}
+            self._scanned = set()
+
+    def _holds(self, source, variable):
+        return (variable in source.get('variables', []) or
+                'variable' in re.compile(source['pattern']).groupindex)
+
+    def _scan_source(self, source):
+        ''' Return a dict of lists of (time, (filename, mapper)) by variable
+        of the files of the source
+        '''
+        entries = {}
+        pattern = re.compile(source['pattern'])
+        for root, dirs, files in os.walk(source['directory']):
+            for name in files:
+                path = os.path.join(root, name)
+                match = pattern.search(
+                        os.path.relpath(path, source['directory']))
+                if not match:
+                    continue
+                groups = match.groupdict()
+                time = datetime.datetime(int(groups['year']),
+                        int(groups['month']), int(groups['day']),
+                        int(groups.get('hour') or 0), tzinfo=timezone.utc)
+                time += datetime.timedelta(
+                        hours=int(groups.get('forecast') or 0))
+                if groups.get('variable'):
+                    variables = [groups['variable']]
+                else:
+                    variables = source.get('variables', [])
+                for variable in variables:
+                    entries.setdefault(variable, []).append((time,
+                        (path, source.get('mapper', ''))))
+        return entries
+
+    def _index_variable(self, variable):
+        ''' Scan the sources which may hold the variable and are not scanned
+        yet, and add their files to the index
+        '''
+        with self._lock:
+            entries = {}
+            for i, source in enumerate(self.sources):
+                if i in self._scanned or not self._holds(source, variable):
+                    continue
+                for var, found in self._scan_source(source).items():
+                    entries.setdefault(var, []).extend(found)
+                self._scanned.add(i)
+            for var, found in entries.items():
+                if var in self._index:
+                    found += list(zip(self._index[var].times,
+                        self._index[var].items))
+                # One sort per variable
+                self._index[var] = TimeIndex(found)
+
+    def find(self, variable, time, tolerance=None):
+        ''' Return (time, filename, mapper) of the file with the variable
+        nearest to time, or None
+        '''
+        self._index_variable(variable)
+        if variable not in self._index:
+            return None
+        found = self._index[variable].nearest(time, tolerance)
+        if found is None:
+            return None
+        ftime, (path, mapper) = found
+        return ftime, path, mapper
+
+class AuxiliaryCache(object):
+    ''' Read-through cache of auxiliary fields reprojected onto target grids
+    or swath geometries
+    '''
+
+    def __init__(self, index=None, memory_size=None, disk_size=None):
+        self.index = index or AuxiliaryIndex()
+        self.memory = LRUCache(memory_size or getattr(settings,
+            'SAR_DOPPLER_AUX_MEMORY_CACHE_SIZE', MEMORY_CACHE_SIZE))
+        self.disk = DiskCache(cache_dir('auxdata'), disk_size or getattr(
+            settings, 'SAR_DOPPLER_AUX_DISK_CACHE_SIZE', DISK_CACHE_SIZE))
+
+    def get(self, variable, time, target, tolerance=None, key=None):
+        ''' Return the field of the variable nearest to time, reprojected
+        onto the target Domain or Nansat object, or None if no file is found.
+        key is the target_key of the target, computed if not given.
+        '''
+        found = self.index.find(variable, time, tolerance)
+        if found is None:
+            return None
+        ftime, path, mapper = found
+        return self.get_file(path, variable, target, mapper, key)
+
+    def get_file(self, path, variable, target, mapper='', key=None):
+        ''' Return the variable of the given file, reprojected onto the
+        target Domain or Nansat object. key is the target_key of the target,
+        computed if not given.
+        '''
+        if key is None:
+            key = target_key(target)
+        key = (path, os.path.getmtime(path), variable, key)
+        data = self.memory.get(key)
+        if data is None:
+            data = self.disk.get(key)
+            if data is None:
+                data = self._read(path, mapper, variable, target)
+                self.disk.set(key, data)
+            self.memory.set(key, data)
+        return data
+
+    def _read(self, path, mapper, variable, target):
+        n = Nansat(path, mapper=mapper)
+        band = n.get_band_number({'standard_name': variable})
+        n.reproject(target, addmask=False)
+        return n[band]
+
+_aux_cache = None
+_aux_cache_lock = threading.Lock()
+
+def aux_cache():
+    ''' Return the auxiliary data cache shared within the process '''
+    global _aux_cache
+    with _aux_cache_lock:
+        if _aux_cache is None:
+            _aux_cache = AuxiliaryCache()
+    return _aux_cache
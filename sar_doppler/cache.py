@@ -0,0 +1,153 @@
+''' Size bounded caches of numpy arrays, in memory and on disk '''
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from django.conf import settings
+
+def cache_dir(name):
+    ''' Return (and create) the directory of the named cache, under
+    settings.SAR_DOPPLER_CACHE_DIR
+    '''
+    root = getattr(settings, 'SAR_DOPPLER_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'sar_doppler_cache'))
+    path = os.path.join(root, name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Created by another process
+            pass
+    return path
+
+def key_digest(key):
+    ''' Return a hex digest of a (tuple) key '''
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def nbytes(value):
+    ''' Return the size in bytes of an array, or of a tuple or dict of arrays '''
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return getattr(value, 'nbytes', 0)
+
+class LRUCache(object):
+    ''' In-memory cache holding at most max_bytes of arrays, evicting the
+    least recently used entries first. Safe to use from several threads.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= nbytes(self._entries.pop(key))
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= nbytes(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self.size -= nbytes(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+class DiskCache(object):
+    ''' Cache of arrays stored as .npy files in a directory, holding at most
+    max_bytes. The least recently used files are removed first.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Size of the files, from the last scan of the directory and the
+        # files written since, or None before the first scan
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key_digest(key) + '.npy')
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            value = np.load(path)
+        except (IOError, OSError, ValueError):
+            return default
+        # Mark as recently used
+        os.utime(path, None)
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, value)
+        os.rename(tmp, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+        # The directory is only scanned when the cache may be full
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        ''' Remove the least recently used files until the cache fits into
+        max_bytes
+        '''
+        with self._lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            size = sum(f[1] for f in files)
+            for mtime, fsize, path in sorted(files):
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= fsize
+            self._size = size
@@ -0,0 +1,111 @@
+''' Collocation of SAR Doppler scenes with auxiliary datasets in time
+
+The collocation service keeps a sorted time index of the datasets of each
+auxiliary source (e.g., NCEP-GFS model winds), built with one query and
+cached, and answers nearest and bracketing lookups in O(log n). Fields can be
+interpolated linearly in time between the two bracketing datasets.
+'''
+import time
+import threading
+from datetime import timedelta
+
+from django.utils import timezone
+
+from geospaas.utils.utils import nansat_filename
+from geospaas.catalog.models import Dataset
+
+from sar_doppler.auxdata import TimeIndex, aux_cache
+
+class CollocationService(object):
+
+    def __init__(self, max_age=600):
+        ''' The time index of a source is rebuilt when it is older than
+        max_age seconds
+        '''
+        self.max_age = max_age
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index(self, source):
+        ''' Return the time index of the datasets of the source platform, with
+        the uri of each dataset as item
+        '''
+        with self._lock:
+            created, index = self._indexes.get(source, (None, None))
+            if index is None or time.time() - created > self.max_age:
+                index = self._build_index(source)
+                self._indexes[source] = (time.time(), index)
+        return index
+
+    def invalidate(self, source=None):
+        with self._lock:
+            if source is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(source, None)
+
+    def _build_index(self, source):
+        uris = {}
+        rows = Dataset.objects.filter(
+                source__platform__short_name=source
+            ).values_list(
+                'id', 'time_coverage_start', 'dataseturi__uri'
+            ).order_by('id', 'dataseturi__id')
+        for ds_id, start, uri in rows:
+            # Use the first uri of each dataset
+            if uri and ds_id not in uris:
+                uris[ds_id] = (start, uri)
+        return TimeIndex(uris.values())
+
+    def nearest(self, source, dt, tolerance=timedelta(hours=3)):
+        ''' Return (time, uri) of the dataset of the source nearest to dt, or
+        None if there is none within the tolerance
+        '''
+        return self.index(source).nearest(_aware(dt), tolerance)
+
+    def bracket(self, source, dt):
+        ''' Return ((t0, uri0), (t1, uri1)) of the datasets of the source
+        before and after dt, or None
+        '''
+        return self.index(source).bracket(_aware(dt))
+
+    def interpolate(self, source, dt, variable, target):
+        ''' Return the variable (standard name) of the source, linearly
+        interpolated in time to dt and reprojected onto the target Domain or
+        Nansat object, or None if dt is not bracketed by the source
+        '''
+        dt = _aware(dt)
+        bracket = self.bracket(source, dt)
+        if bracket is None:
+            return None
+        (t0, uri0), (t1, uri1) = bracket
+        field0 = aux_cache().get_file(nansat_filename(uri0), variable, target)
+        if uri1 == uri0:
+            return field0
+        field1 = aux_cache().get_file(nansat_filename(uri1), variable, target)
+        w1 = interpolation_weight(dt, t0, t1)
+        return (1 - w1)*field0 + w1*field1
+
+def interpolation_weight(dt, t0, t1):
+    ''' Return the weight of the value at t1 for linear interpolation to dt
+    between t0 and t1
+    '''
+    if t1 == t0:
+        return 0.
+    return (dt - t0).total_seconds() / (t1 - t0).total_seconds()
+
+def _aware(dt):
+    if timezone.is_naive(dt):
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+_service = None
+_service_lock = threading.Lock()
+
+def collocation_service():
+    ''' Return the collocation service shared within the process '''
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = CollocationService()
+    return _service
@@ -0,0 +1,245 @@
+''' Extraction of time series of Doppler products at a point or in a small
+region, and of windowed subsets of the products
+
+The datasets covering the point or region are found with a spatial query,
+and only the pixels of the window covering it are read from the exported
+subswath netcdf products.
+'''
+import os
+import re
+import threading
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+from django.contrib.gis.geos import Point, Polygon
+
+from geospaas.utils.utils import nansat_filename
+
+from nansat.nansat import Nansat
+
+from sar_doppler.models import Dataset, SubswathFootprint
+from sar_doppler.cache import LRUCache
+from sar_doppler.raster import read_lines
+from sar_doppler.stats import radial_velocity_uncertainty
+
+# Bands extracted in addition to the radial velocity uncertainty
+EXTRACTED_BANDS = ['fdg', 'Ur', 'incidence_angle', 'sensor_azimuth']
+
+SUBSWATH_PRODUCT = re.compile(r'subswath(\d)\.nc$')
+
+def query_geometry(lon, lat, bbox=None):
+    ''' Return a point geometry, or the polygon of bbox (west, south, east,
+    north) if given
+    '''
+    if bbox is None:
+        return Point(lon, lat, srid=4326)
+    west, south, east, north = bbox
+    return Polygon(((west, south), (east, south), (east, north),
+        (west, north), (west, south)), srid=4326)
+
+# Maximum number of lines and columns of the geolocation grids read to find
+# the pixel window of a region
+WINDOW_GRID_SIZE = 1000
+
+def _point_window(n, lon, lat, margin):
+    cols, rows = n.transform_points([lon], [lat], DstToSrc=1)
+    col, row = float(np.asarray(cols)[0]), float(np.asarray(rows)[0])
+    nrows, ncols = n.shape()
+    if not (np.isfinite(col) and np.isfinite(row) and 0 <= col < ncols and
+            0 <= row < nrows):
+        return None
+    return (max(int(col) - margin, 0), max(int(row) - margin, 0),
+            min(int(col) + 1 + margin, ncols), min(int(row) + 1 + margin, nrows))
+
+def pixel_window(n, lon, lat, bbox=None, margin=0):
+    ''' Return (x_offset, y_offset, x_size, y_size) of the pixels of n
+    covering the point or bbox, extended by margin pixels on each side and
+    clipped to n, or None if it is outside n.
+
+    The window of a bbox is found from the geolocation grids of n (decimated
+    to at most WINDOW_GRID_SIZE lines and columns), so it is also found when
+    the bbox only partly overlaps n.
+    '''
+    if bbox is None:
+        window = _point_window(n, lon, lat, margin)
+    else:
+        west, south, east, north = bbox
+        nrows, ncols = n.shape()
+        step = max(1, max(nrows, ncols)//WINDOW_GRID_SIZE)
+        glon, glat = n.get_geolocation_grids(stepSize=step)
+        inside = (glon >= west) & (glon <= east) & (glat >= south) & \
+                (glat <= north)
+        rows = np.where(inside.any(axis=1))[0]
+        cols = np.where(inside.any(axis=0))[0]
+        if len(rows) == 0:
+            # A bbox smaller than the grid spacing
+            return _point_window(n, (west + east)/2., (south + north)/2.,
+                    margin + step)
+        # Grid points are step pixels apart
+        margin += step
+        window = (max(cols[0]*step - margin, 0), max(rows[0]*step - margin, 0),
+                min((cols[-1] + 1)*step + margin, ncols),
+                min((rows[-1] + 1)*step + margin, nrows))
+    if window is None:
+        return None
+    x0, y0, x1, y1 = [int(v) for v in window]
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+def subswath_products(ds):
+    ''' Return a list of (subswath, uri) of the exported subswath products of
+    the dataset
+    '''
+    products = []
+    for dsuri in ds.dataseturi_set.filter(uri__endswith='.nc'):
+        match = SUBSWATH_PRODUCT.search(dsuri.uri)
+        if match:
+            products.append((int(match.group(1)), dsuri.uri))
+    return sorted(products)
+
+def intersecting_products(geometry, datetime_start, datetime_end):
+    ''' Return a time ordered list of (dataset, subswath, uri) of the
+    subswath products intersecting the geometry between datetime_start and
+    datetime_end.
+
+    Products with a stored footprint are selected at subswath granularity
+    with a spatial query. For datasets processed before footprints were
+    stored, all subswath products of the intersecting datasets are returned
+    (their footprints are added by the add_sar_doppler_footprints command).
+    '''
+    footprints = SubswathFootprint.objects.filter(
+            dataset__entry_title__contains='Doppler',
+            dataset__time_coverage_start__range=[datetime_start, datetime_end],
+            geometry__intersects=geometry
+        ).select_related('dataset', 'uri')
+    products = [(fp.dataset, fp.subswath, fp.uri.uri) for fp in footprints]
+    legacy = Dataset.objects.filter(entry_title__contains='Doppler',
+            time_coverage_start__range=[datetime_start, datetime_end],
+            geographic_location__geometry__intersects=geometry,
+            subswathfootprint__isnull=True)
+    for ds in legacy:
+        for subswath, uri in subswath_products(ds):
+            products.append((ds, subswath, uri))
+    return sorted(products, key=lambda p: (p[0].time_coverage_start, p[1]))
+
+def read_window(fn, lon, lat, bbox=None):
+    ''' Return a dict with the mean and standard deviation of the extracted
+    bands in the window of the product fn covering the point or bbox, or None
+    if the product does not cover it
+    '''
+    n = Nansat(fn)
+    window = pixel_window(n, lon, lat, bbox)
+    if window is None:
+        return None
+    if window != (0, 0, n.shape()[1], n.shape()[0]):
+        n.crop(*window)
+    values = {}
+    with warnings.catch_warnings():
+        # All-nan windows
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for band in EXTRACTED_BANDS:
+            if not n.has_band(band):
+                continue
+            data = n[band].astype(float)
+            values[band] = np.nanmean(data)
+            values[band + '_std'] = np.nanstd(data)
+        if 'incidence_angle' in values:
+            values['Ur_uncertainty'] = radial_velocity_uncertainty(
+                    values['incidence_angle'])
+    values['num_pixels'] = window[2]*window[3]
+    return values
+
+def extract_timeseries(lon, lat, datetime_start, datetime_end, bbox=None):
+    ''' Return a time ordered list of dicts with the Doppler products (fdg,
+    Ur with uncertainty, and viewing geometry) at the point lon, lat, or
+    averaged over the bbox (west, south, east, north) if given, between
+    datetime_start and datetime_end.
+    '''
+    geometry = query_geometry(lon, lat, bbox)
+    timeseries = []
+    for ds, subswath, uri in intersecting_products(geometry, datetime_start,
+            datetime_end):
+        values = read_window(nansat_filename(uri), lon, lat, bbox)
+        if values is None:
+            continue
+        values.update({
+            'time': ds.time_coverage_start,
+            'dataset': ds.id,
+            'subswath': subswath,
+        })
+        timeseries.append(values)
+    return timeseries
+
+class ProductHandles(object):
+    ''' Least recently used cache of open products (Nansat objects), each
+    with a lock since GDAL datasets can not be read from several threads at
+    the same time
+    '''
+
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fn):
+        ''' Return (lock, Nansat object) of the product fn '''
+        with self._lock:
+            key = (fn, os.path.getmtime(fn))
+            if key in self._handles:
+                handle = self._handles.pop(key)
+            else:
+                handle = (threading.Lock(), Nansat(fn))
+            self._handles[key] = handle
+            while len(self._handles) > self.max_open:
+                self._handles.popitem(last=False)
+            return handle
+
+# Open products and recently served subsets, shared within the process
+product_handles = ProductHandles()
+subset_cache = LRUCache(256*1024**2)
+
+def iter_subset(fn, variable, bbox=None, stride=1, chunk_lines=256):
+    ''' Return (shape, dtype, chunks) of the variable of the product fn
+    within bbox (west, south, east, north; the full product if None),
+    decimated by stride. chunks is an iterator over consecutive blocks of
+    lines of the subset, read when iterated over.
+
+    Raises ValueError if the product does not have the variable or does not
+    cover the bbox, and IOError or OSError if the product is missing.
+    '''
+    lock, n = product_handles.get(fn)
+    with lock:
+        if not n.has_band(variable):
+            raise ValueError('%s has no variable %s' % (fn, variable))
+        if bbox is None:
+            window = (0, 0, n.shape()[1], n.shape()[0])
+        else:
+            window = pixel_window(n, None, None, bbox)
+    if window is None:
+        raise ValueError('%s does not cover %s' % (fn, bbox))
+    key = (fn, os.path.getmtime(fn), variable, window, stride)
+    cached = subset_cache.get(key)
+    if cached is not None:
+        return cached.shape, cached.dtype, iter([cached])
+
+    x_offset, y_offset, x_size, y_size = window
+    lines = chunk_lines*stride
+    def read(y0):
+        with lock:
+            return read_lines(n, variable, x_offset, y_offset + y0, x_size,
+                    min(lines, y_size - y0), stride)
+    first = read(0)
+    shape = (len(range(0, y_size, stride)), first.shape[1])
+    def chunks():
+        yield first
+        for y0 in range(lines, y_size, lines):
+            yield read(y0)
+    if shape[0]*shape[1]*first.itemsize <= subset_cache.max_bytes // 16:
+        # Keep small subsets for repeated requests
+        data = np.concatenate(list(chunks()))
+        subset_cache.set(key, data)
+        return shape, data.dtype, iter([data])
+    return shape, first.dtype, chunks()
@@ -0,0 +1,63 @@
+''' Lookup of the Doppler intermediates of processed subswaths
+
+The Doppler anomaly, the geophysical Doppler shift and the masks of each
+subswath are computed by DatasetManager.process and exported to the subswath
+product. They are read from the product when it is newer than the source
+file, and only recomputed when the product or the band is missing or the
+product is stale. Recomputed fields are kept in memory for reuse within the
+process.
+'''
+import os
+
+from sar_doppler.managers import subswath_product_filename
+from sar_doppler.cache import LRUCache
+from sar_doppler.extract import product_handles, read_lines
+
+# Bands of the subswath products holding the intermediates
+INTERMEDIATE_BANDS = {
+    'anomaly': 'dca',
+    'fdg': 'fdg',
+    'valid_doppler': 'valid_doppler',
+    'valid_land_doppler': 'valid_land_doppler',
+    'valid_sea_doppler': 'valid_sea_doppler',
+}
+
+intermediate_cache = LRUCache(512*1024**2)
+
+def source_filename(n):
+    ''' Return the gsar file of n, which is either read from it or from its
+    exported subswath product
+    '''
+    return n.get_metadata().get('Originating file', n.filename)
+
+def intermediate(source, subswath, name, compute, window=None):
+    ''' Return the intermediate field name (see INTERMEDIATE_BANDS) of the
+    subswath of the gsar file source, in the window (x_offset, y_offset,
+    x_size, y_size) or the full subswath if None. compute() is called to
+    compute the field if it is not found. If the source file is missing, the
+    product is used without checking that it is up to date.
+    '''
+    try:
+        source_mtime = os.path.getmtime(source)
+    except OSError:
+        # Moved away (e.g. to *.error) - the product is used if it exists
+        source_mtime = None
+    product = subswath_product_filename(source, subswath)
+    product_mtime = os.path.getmtime(product) if os.path.isfile(product) \
+            else None
+    key = (source, source_mtime, product_mtime, int(subswath), name, window)
+    data = intermediate_cache.get(key)
+    if data is not None:
+        return data
+    if product_mtime is not None and (source_mtime is None or
+            product_mtime >= source_mtime):
+        lock, n = product_handles.get(product)
+        with lock:
+            if n.has_band(INTERMEDIATE_BANDS[name]):
+                if window is None:
+                    window = (0, 0, n.shape()[1], n.shape()[0])
+                data = read_lines(n, INTERMEDIATE_BANDS[name], *window)
+    if data is None:
+        data = compute()
+    intermediate_cache.set(key, data)
+    return data
@@ -0,0 +1,217 @@
+''' Columnar store of the land Doppler samples of the processed subswaths
+
+The land Doppler calibration (utils.update_geophysical_doppler) only needs
+the Doppler anomaly, view angle and its standard deviation at the pixels
+flagged as valid land Doppler. These are appended to the store as each
+subswath is processed, so that calibration queries read the samples rather
+than the full subswath products.
+
+The samples are kept in one directory per platform, instrument, polarization,
+orbit pass and subswath, with one float32 file per column and a segment table of
+(time, offset, count) rows - one segment per subswath product. The columns
+are read with memory maps. The products of the segments are listed in the
+same order with their modification time. When a product is reprocessed, its
+new samples are appended and the count of its old segment is set to 0.
+'''
+import os
+import fcntl
+import calendar
+import threading
+
+import numpy as np
+
+from django.conf import settings
+
+from geospaas.utils.utils import nansat_filename
+
+from sar_doppler.cache import cache_dir
+from sar_doppler.raster import read_lines
+
+LAND_COLUMNS = ['dca', 'view_angle', 'std_dca']
+
+VIEW_ANGLE_STANDARD_NAME = 'sensor_view_angle'
+STD_DCA_STANDARD_NAME = 'standard_deviation_of_surface_backwards_doppler_centroid_frequency_shift_of_radar_wave'
+
+# Lines of the subswaths read at a time
+BLOCK_SIZE = 512
+
+def epoch(dt):
+    ''' Return the seconds since 1970 of an aware datetime '''
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond*1e-6
+
+def orbit_pass(n):
+    ''' Return 'ascending' or 'descending', from the latitude at mid range
+    of the subswath n
+    '''
+    nrows, ncols = n.shape()
+    lon, lat = n.transform_points([ncols//2, ncols//2], [nrows//2, 0])
+    if lat[0] > lat[1]:
+        return 'ascending'
+    return 'descending'
+
+def land_samples(n, block_size=None):
+    ''' Return (polarization, orbit pass, columns) of the land Doppler samples
+    of the subswath n, where columns is a dict of float32 arrays. The
+    subswath is read over azimuth blocks of block_size (default BLOCK_SIZE)
+    lines, and the bands other than the land mask only where there is land.
+    '''
+    view_band = n.get_band_number({'standard_name': VIEW_ANGLE_STANDARD_NAME})
+    std_band = n.get_band_number({'standard_name': STD_DCA_STANDARD_NAME})
+    polarization = n.get_metadata(band_id=std_band, key='polarization')
+    nrows, ncols = n.shape()
+    lines = block_size or BLOCK_SIZE
+    columns = dict((name, []) for name in LAND_COLUMNS)
+    for y0 in range(0, nrows, lines):
+        land = read_lines(n, 'valid_land_doppler', 0, y0, ncols,
+                min(lines, nrows - y0)) == 1
+        rows = np.where(land.any(axis=1))[0]
+        if not len(rows):
+            continue
+        # Read only the lines with land
+        land = land[rows[0]:rows[-1] + 1]
+        window = (0, y0 + int(rows[0]), ncols, int(rows[-1] + 1 - rows[0]))
+        block = {
+            'dca': read_lines(n, 'dca', *window)[land],
+            'view_angle': read_lines(n, view_band, *window)[land],
+            'std_dca': read_lines(n, std_band, *window)[land],
+        }
+        valid = np.isfinite(block['dca']) & np.isfinite(block['view_angle'])
+        for name in LAND_COLUMNS:
+            columns[name].append(block[name][valid].astype(np.float32))
+    for name in LAND_COLUMNS:
+        columns[name] = np.concatenate(columns[name] or
+                [np.zeros(0, dtype=np.float32)])
+    return polarization, orbit_pass(n), columns
+
+class LandDopplerStore(object):
+
+    def __init__(self, root=''):
+        self.root = root or getattr(settings, 'SAR_DOPPLER_LAND_STORE_DIR',
+                '') or cache_dir('landstore')
+        self._lock = threading.Lock()
+
+    def _directory(self, platform, instrument, subswath, polarization,
+            orbit_pass):
+        return os.path.join(self.root, platform, instrument, polarization,
+                orbit_pass, 'subswath%d' % int(subswath))
+
+    def _segments(self, directory):
+        path = os.path.join(directory, 'segments.f8')
+        if not os.path.isfile(path):
+            return np.zeros((0, 3))
+        return np.fromfile(path, dtype=np.float64).reshape(-1, 3)
+
+    def _sources(self, directory):
+        ''' Return a list of (source, mtime) of the segments of the directory.
+        mtime is None for segments appended without it.
+        '''
+        path = os.path.join(directory, 'sources.txt')
+        if not os.path.isfile(path):
+            return []
+        sources = []
+        with open(path) as f:
+            for line in f:
+                source, sep, mtime = line.rstrip('\n').partition('\t')
+                sources.append((source, float(mtime) if sep and
+                    mtime != 'None' else None))
+        return sources
+
+    def sources(self):
+        ''' Return a dict of the modification times of the products whose
+        samples are in the store, by product
+        '''
+        sources = {}
+        for root, dirs, files in os.walk(self.root):
+            if 'sources.txt' in files:
+                sources.update(self._sources(root))
+        return sources
+
+    def append(self, platform, instrument, subswath, polarization, orbit_pass,
+            time, source, columns, mtime=None):
+        ''' Append the samples of the product source, acquired at time (an
+        aware datetime) and modified at mtime, unless they are already in the
+        store. The samples of earlier versions of the product are dropped.
+        '''
+        directory = self._directory(platform, instrument, subswath,
+                polarization, orbit_pass)
+        with self._lock:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created by another process
+                    pass
+            # Several processes may append at the same time
+            with open(os.path.join(directory, '.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                sources = self._sources(directory)
+                if (source, mtime) in sources:
+                    return
+                # Drop a segment left by an interrupted append
+                segments = self._segments(directory)[:len(sources)]
+                offset = int(segments[-1, 1] + segments[-1, 2]) if len(
+                        segments) else 0
+                count = len(columns[LAND_COLUMNS[0]])
+                for name in LAND_COLUMNS:
+                    with open(os.path.join(directory, name + '.f4'), 'ab') as f:
+                        # Drop samples left by an interrupted append
+                        f.truncate(offset*4)
+                        np.asarray(columns[name], dtype=np.float32).tofile(f)
+                with open(os.path.join(directory, 'segments.f8'), 'r+b' if
+                        os.path.isfile(os.path.join(directory, 'segments.f8'))
+                        else 'wb') as f:
+                    f.truncate(len(segments)*3*8)
+                    f.seek(len(segments)*3*8)
+                    np.array([epoch(time), offset, count],
+                            dtype=np.float64).tofile(f)
+                    # Samples of earlier versions of the product are not read
+                    for j, (old, old_mtime) in enumerate(sources):
+                        if old == source:
+                            f.seek((3*j + 2)*8)
+                            np.zeros(1, dtype=np.float64).tofile(f)
+                with open(os.path.join(directory, 'sources.txt'), 'a') as f:
+                    f.write('%s\t%r\n' % (source, mtime))
+
+    def read(self, platform, instrument, subswath, polarization, orbit_pass,
+            datetime_start, datetime_end):
+        ''' Return a dict of the columns of the samples acquired from
+        datetime_start (inclusive) to datetime_end (exclusive)
+        '''
+        directory = self._directory(platform, instrument, subswath,
+                polarization, orbit_pass)
+        segments = self._segments(directory)
+        t0, t1 = epoch(datetime_start), epoch(datetime_end)
+        selected = segments[(segments[:, 0] >= t0) & (segments[:, 0] < t1)]
+        columns = {}
+        for name in LAND_COLUMNS:
+            if not selected[:, 2].sum():
+                columns[name] = np.zeros(0, dtype=np.float32)
+                continue
+            data = np.memmap(os.path.join(directory, name + '.f4'),
+                    dtype=np.float32, mode='r')
+            columns[name] = np.concatenate([data[int(offset):int(offset+count)]
+                for time, offset, count in selected])
+        return columns
+
+def source_mtime(source):
+    ''' Return the modification time of the product source (a uri) '''
+    return os.path.getmtime(nansat_filename(source))
+
+def add_samples(ds, n, source, store=None, block_size=None):
+    ''' Append the land Doppler samples of the subswath n of the dataset ds,
+    exported to the product source
+    '''
+    polarization, opass, columns = land_samples(n, block_size)
+    (store or land_store()).append(ds.source.platform.short_name,
+            ds.source.instrument.short_name, n.get_metadata('subswath'),
+            polarization, opass,
+            ds.time_coverage_start, source, columns, source_mtime(source))
+
+_land_store = None
+
+def land_store():
+    ''' Return the land Doppler store shared within the process '''
+    global _land_store
+    if _land_store is None:
+        _land_store = LandDopplerStore()
+    return _land_store
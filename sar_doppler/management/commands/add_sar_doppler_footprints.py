@@ -0,0 +1,38 @@
+''' Store the footprints of subswath products processed before they were stored '''
+import logging
+from django.core.management.base import BaseCommand
+
+from nansat.exceptions import NansatGeolocationError
+
+from sar_doppler.models import Dataset
+
+logging.basicConfig(filename='add_sar_doppler_footprints.log',
+        level=logging.INFO)
+
+class Command(BaseCommand):
+    help = 'Store the footprints of the exported subswath products which ' \
+            'have none, so that they are found at subswath granularity by ' \
+            'the spatial queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', type=str, default='')
+
+    def handle(self, *args, **options):
+        legacy = Dataset.objects.filter(
+                entry_title__contains='Doppler',
+                dataseturi__uri__contains=options['file'],
+                subswathfootprint__isnull=True
+            ).filter(
+                dataseturi__uri__endswith='.nc'
+            ).distinct()
+        num_legacy = len(legacy)
+
+        self.stdout.write('Adding footprints of %d datasets\n' % num_legacy)
+        for i, ds in enumerate(legacy):
+            try:
+                added = Dataset.objects.add_footprints(ds)
+            except (ValueError, IOError, NansatGeolocationError) as e:
+                logging.exception(repr(e))
+                continue
+            self.stdout.write('Added %d footprints (%d/%d): %s\n' % (added,
+                i+1, num_legacy, ds))
@@ -0,0 +1,61 @@
+''' Benchmark of the start-up cost of the sar_doppler app '''
+import os
+import sys
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Modules that should only be imported when Doppler data is processed.
+# matplotlib is not listed, since nansat.nansat imports it through
+# nansat.figure, and nansat is needed at start-up by geospaas.
+HEAVY_MODULES = ['sardoppler', 'scipy']
+
+# Run in a fresh interpreter, since the app is already loaded in this one
+BENCHMARK = '''
+import json, resource, sys, time
+t0 = time.time()
+import django
+django.setup()
+import sar_doppler.models, sar_doppler.views
+t1 = time.time()
+loaded = [m for m in %r if m in sys.modules]
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+from sardoppler.sardoppler import Doppler
+t2 = time.time()
+print(json.dumps({'setup': t1 - t0, 'first_use': t2 - t1, 'maxrss': maxrss,
+    'loaded': loaded}))
+''' % HEAVY_MODULES
+
+class Command(BaseCommand):
+    help = 'Measure the time and memory used to load the sar_doppler app, ' \
+            'and list the heavy modules imported at start-up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5,
+                help='Number of fresh interpreters to start')
+
+    def handle(self, *args, **options):
+        results = []
+        for i in range(options['repeat']):
+            try:
+                output = subprocess.check_output([sys.executable, '-c',
+                    BENCHMARK], env=os.environ.copy())
+            except subprocess.CalledProcessError as e:
+                raise CommandError('Benchmark failed: %s' % e)
+            results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+
+        setup = sorted(r['setup'] for r in results)[len(results)//2]
+        first_use = sorted(r['first_use'] for r in results)[len(results)//2]
+        maxrss = sorted(r['maxrss'] for r in results)[len(results)//2]
+        self.stdout.write('App start-up (django.setup): %.3f s (median of %d)\n'
+                % (setup, len(results)))
+        self.stdout.write('Peak memory at start-up: %d kB\n' % maxrss)
+        self.stdout.write('Loading the processing stack on first use: %.3f s\n'
+                % first_use)
+        loaded = results[-1]['loaded']
+        if loaded:
+            self.stdout.write('Heavy modules imported at start-up: %s\n'
+                    % ', '.join(loaded))
+        else:
+            self.stdout.write('No heavy modules imported at start-up\n')
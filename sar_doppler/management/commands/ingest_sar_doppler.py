@@ -14,6 +14,7 @@ from geospaas.catalog.models import Dataset as catalogDataset
 
 from sar_doppler.models import Dataset
 from sar_doppler.errors import AlreadyExists
+from sar_doppler.profiling import add_profile_arguments, command_profiler, profiled
 import os
 
 logging.basicConfig(filename='ingest_sar_doppler.log', level=logging.INFO)
@@ -27,13 +28,15 @@ class Command(BaseCommand):
         parser.add_argument('gsar_files', nargs='*', type=str)
         parser.add_argument('--reprocess', action='store_true', 
                 help='Force reprocessing')
+        add_profile_arguments(parser)
 
     def handle(self, *args, **options):
-
+        profiler = command_profiler(options)
         for uri in uris_from_args(options['gsar_files']):
             self.stdout.write('Ingesting %s ...\n' % uri)
             try:
-                ds, cr = Dataset.objects.get_or_create(uri, **options)
+                with profiled(profiler, uri):
+                    ds, cr = Dataset.objects.get_or_create(uri, **options)
             except (MultipleObjectsReturned, NansatGeolocationError, IntegrityError) as e:
                 logging.exception(uri+': '+repr(e))
                 continue
@@ -48,6 +51,5 @@ class Command(BaseCommand):
                     self.stdout.write('Successfully added: %s\n' % uri)
                 else:
                     self.stdout.write('Was already added: %s\n' % uri)
-
-
-
+        if profiler:
+            profiler.write_report(self.stdout)
@@ -1,10 +1,13 @@
 ''' Processing of SAR Doppler from Norut's GSAR '''
 import logging
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from nansat.exceptions import NansatGeolocationError
 
 from sar_doppler.models import Dataset
+from sar_doppler.pipeline import ScenePipeline
+from sar_doppler.scheduler import MemoryScheduler
+from sar_doppler.profiling import add_profile_arguments, command_profiler, profiled
 
 logging.basicConfig(filename='process_ingested_sar_doppler.log', level=logging.INFO)
 
@@ -14,11 +17,32 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--file', type=str, default='')
+        parser.add_argument('--block-size', type=int, default=None,
+                help='Compute Doppler products over azimuth blocks of this '
+                'number of lines to limit memory use')
+        parser.add_argument('--merged', action='store_true',
+                help='Create merged figures of all subswaths instead of one '
+                'figure per subswath')
+        parser.add_argument('--pipeline', action='store_true',
+                help='Overlap reading, computation and output of the scenes')
+        parser.add_argument('--prefetch', type=int, default=2,
+                help='Number of scenes to read ahead in pipeline mode')
+        parser.add_argument('--memory-budget', type=int, default=None,
+                help='Process scenes in parallel worker processes, within '
+                'this memory budget [MB]')
+        parser.add_argument('--workers', type=int, default=None,
+                help='Maximum number of worker processes with '
+                '--memory-budget (default: the number of CPUs)')
+        add_profile_arguments(parser)
     #    Reprocessing should probably be a separate command
     #    parser.add_argument('--reprocess', action='store_true', 
     #            help='Force reprocessing')
 
     def handle(self, *args, **options):
+        profiler = command_profiler(options)
+        if profiler and (options['pipeline'] or options['memory_budget']):
+            raise CommandError('Profiling is only supported when processing '
+                    'one scene at a time')
         unprocessed = Dataset.objects.filter(
                 entry_title='SAR Doppler',
                 dataseturi__uri__contains=options['file']
@@ -28,19 +52,72 @@ class Command(BaseCommand):
         num_unprocessed = len(unprocessed)
 
         print('Processing %d datasets' %num_unprocessed)
+        if options['pipeline']:
+            self.process_pipelined(unprocessed, options)
+            return
+        if options['memory_budget']:
+            self.process_scheduled(unprocessed, options)
+            return
         for i,ds in enumerate(unprocessed):
             uri = ds.dataseturi_set.get(uri__endswith='.gsar').uri
             try:
-                updated_ds, processed = Dataset.objects.process(uri)
+                with profiled(profiler, uri):
+                    updated_ds, processed = Dataset.objects.process(uri,
+                            block_size=options['block_size'],
+                            merged=options['merged'])
             except (ValueError, IOError, NansatGeolocationError):
                 # some files manually moved to *.error...
                 continue
-            if processed:
-                self.stdout.write('Successfully processed (%d/%d): %s\n' % (i+1, num_unprocessed,
-                    uri))
-            else:
-                msg = 'Corrupt file (%d/%d, may have been partly processed): %s\n' %(i+1,
-                    num_unprocessed, uri)
-                logging.info(msg)
-                self.stdout.write(msg)
+            self.report(uri, processed, i, num_unprocessed)
+        if profiler:
+            profiler.write_report(self.stdout)
 
+    def report(self, uri, processed, i, num_unprocessed):
+        if processed:
+            self.stdout.write('Successfully processed (%d/%d): %s\n' % (i+1, num_unprocessed,
+                uri))
+        else:
+            msg = 'Corrupt file (%d/%d, may have been partly processed): %s\n' %(i+1,
+                num_unprocessed, uri)
+            logging.info(msg)
+            self.stdout.write(msg)
+
+    def process_pipelined(self, unprocessed, options):
+        num_unprocessed = len(unprocessed)
+        done = []
+        def callback(uri, ds, processed, error):
+            done.append(uri)
+            if isinstance(error, (ValueError, IOError, NansatGeolocationError)):
+                # some files manually moved to *.error...
+                return
+            elif error is not None:
+                logging.error(uri+': '+repr(error))
+                return
+            self.report(uri, processed, len(done)-1, num_unprocessed)
+
+        pipeline = ScenePipeline(Dataset.objects, prefetch=options['prefetch'],
+                callback=callback, block_size=options['block_size'],
+                merged=options['merged'])
+        for ds in unprocessed:
+            pipeline.submit(ds.dataseturi_set.get(uri__endswith='.gsar').uri)
+        pipeline.close()
+        pipeline.join()
+
+    def process_scheduled(self, unprocessed, options):
+        num_unprocessed = len(unprocessed)
+        done = []
+        def callback(uri, processed, error):
+            done.append(uri)
+            if isinstance(error, (ValueError, IOError, NansatGeolocationError)):
+                return
+            elif error is not None:
+                logging.error(uri+': '+repr(error))
+                return
+            self.report(uri, processed, len(done)-1, num_unprocessed)
+
+        uris = [ds.dataseturi_set.get(uri__endswith='.gsar').uri
+                for ds in unprocessed]
+        scheduler = MemoryScheduler(Dataset.objects,
+                options['memory_budget']*1024**2, workers=options['workers'],
+                block_size=options['block_size'], merged=options['merged'])
+        scheduler.run(uris, callback)
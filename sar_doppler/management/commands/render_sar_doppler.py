@@ -0,0 +1,43 @@
+''' Recreate figures of processed SAR Doppler products without reprocessing '''
+import logging
+from django.core.management.base import BaseCommand
+
+from nansat.exceptions import NansatGeolocationError
+
+from sar_doppler.models import Dataset
+
+logging.basicConfig(filename='render_sar_doppler.log', level=logging.INFO)
+
+class Command(BaseCommand):
+    help = 'Regenerate png images for display in Leaflet from the exported ' \
+            'netcdf products, e.g., after changing the figure style'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', type=str, default='')
+        parser.add_argument('--merged', action='store_true',
+                help='Create merged figures of all subswaths instead of one '
+                'figure per subswath')
+
+    def handle(self, *args, **options):
+        processed = Dataset.objects.filter(
+                entry_title='SAR Doppler',
+                dataseturi__uri__contains=options['file']
+            ).filter(
+                dataseturi__uri__endswith='.nc'
+            ).distinct()
+        num_processed = len(processed)
+
+        print('Rendering %d datasets' %num_processed)
+        for i,ds in enumerate(processed):
+            try:
+                rendered = Dataset.objects.render(ds, merged=options['merged'])
+            except (ValueError, IOError, NansatGeolocationError) as e:
+                logging.exception(repr(e))
+                continue
+            if rendered:
+                self.stdout.write('Successfully rendered (%d/%d): %s\n' % (i+1,
+                    num_processed, ds))
+            else:
+                msg = 'Could not render (%d/%d): %s\n' % (i+1, num_processed, ds)
+                logging.info(msg)
+                self.stdout.write(msg)
@@ -0,0 +1,111 @@
+''' Continuous ingestion and processing of new GSAR files in archive directories '''
+import os
+import signal
+import logging
+import threading
+
+from nansat.exceptions import NansatGeolocationError
+
+from django.db import close_old_connections
+from django.core.management.base import BaseCommand
+
+from geospaas.utils.utils import uris_from_args
+
+from sar_doppler.models import Dataset
+from sar_doppler.cache import cache_dir
+from sar_doppler.pipeline import ScenePipeline, ScanCursor
+
+logging.basicConfig(filename='watch_sar_doppler.log', level=logging.INFO)
+
+class Command(BaseCommand):
+    help = 'Watch archive directories for new GSAR files, and ingest and ' \
+            'process them as they arrive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directories', nargs='+', type=str)
+        parser.add_argument('--interval', type=float, default=60,
+                help='Seconds between scans of the directories')
+        parser.add_argument('--settle', type=float, default=60,
+                help='Seconds since the last modification before a file is '
+                'considered complete')
+        parser.add_argument('--cursor', type=str, default='',
+                help='File where the scan position is kept between runs')
+        parser.add_argument('--workers', type=int, default=1,
+                help='Number of scenes processed at the same time')
+        parser.add_argument('--prefetch', type=int, default=2,
+                help='Number of scenes to read ahead')
+        parser.add_argument('--block-size', type=int, default=None,
+                help='Compute Doppler products over azimuth blocks of this '
+                'number of lines to limit memory use')
+        parser.add_argument('--merged', action='store_true',
+                help='Create merged figures of all subswaths instead of one '
+                'figure per subswath')
+        parser.add_argument('--once', action='store_true',
+                help='Exit when the files found in one scan are processed')
+
+    def handle(self, *args, **options):
+        cursor = ScanCursor(options['cursor'] or
+                os.path.join(cache_dir('watch'), 'cursor.json'))
+        stop = threading.Event()
+        def shutdown(signum, frame):
+            self.stdout.write('Stopping after the scenes in progress\n')
+            stop.set()
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        # Scenes submitted and not yet done, by uri
+        in_progress = {}
+        lock = threading.Lock()
+        def callback(uri, ds, processed, error):
+            with lock:
+                path, ctime = in_progress.pop(uri)
+            if isinstance(error, (ValueError, IOError, NansatGeolocationError)):
+                logging.info('Could not process %s: %s' % (uri, repr(error)))
+            elif error is not None:
+                # Unexpected - retry later
+                logging.error(uri+': '+repr(error))
+                if cursor.mark_failed(path, ctime):
+                    logging.error('Giving up %s after %d attempts' % (uri,
+                        cursor.MAX_ATTEMPTS))
+                return
+            elif processed:
+                self.stdout.write('Successfully processed: %s\n' % uri)
+            else:
+                msg = 'Corrupt file (may have been partly processed): %s\n' % uri
+                logging.info(msg)
+                self.stdout.write(msg)
+            cursor.mark_done(path, ctime)
+
+        # submit blocks while the pipeline is full, which holds back the scan
+        pipeline = ScenePipeline(Dataset.objects, prefetch=options['prefetch'],
+                callback=callback, compute_workers=options['workers'],
+                block_size=options['block_size'], merged=options['merged'])
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                with lock:
+                    submitted = set(path for path, ctime in in_progress.values())
+                for ctime, path in cursor.new_files(options['directories'],
+                        settle=options['settle']):
+                    if stop.is_set():
+                        break
+                    if path in submitted:
+                        continue
+                    uri = uris_from_args([path])[0]
+                    if self.processed(uri):
+                        cursor.mark_done(path, ctime)
+                        continue
+                    with lock:
+                        in_progress[uri] = (path, ctime)
+                    pipeline.submit(uri)
+                if options['once']:
+                    break
+                stop.wait(options['interval'])
+        finally:
+            pipeline.close()
+            pipeline.join()
+
+    def processed(self, uri):
+        ''' Return True if the scene was already ingested and processed '''
+        return Dataset.objects.filter(dataseturi__uri=uri).filter(
+                dataseturi__uri__endswith='.nc').exists()
@@ -1,14 +1,13 @@
-import os, warnings
+import os, copy, warnings, tempfile, hashlib
 from math import sin, pi, cos, acos, copysign
 import numpy as np
-from scipy.ndimage.filters import median_filter
 
 from dateutil.parser import parse
 from datetime import timedelta
 
 from django.conf import settings
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.gis.geos import WKTReader
 
 from geospaas.utils.utils import nansat_filename, media_path, product_path
@@ -21,9 +20,139 @@ from geospaas.nansat_ingestor.managers import DatasetManager as DM
 
 from nansat.nansat import Nansat
 from nansat.nsr import NSR
-from nansat.domain import Domain
 from nansat.figure import Figure
-from sardoppler.sardoppler import Doppler
+from nansat.domain import Domain
+
+from sar_doppler.overviews import write_overviews, product_pixel_spacing
+from sar_doppler.overviews import overview_geolocation, block_mean, OVERVIEW_MASKS
+from sar_doppler.overviews import select_product
+from sar_doppler.landstore import add_samples
+
+# sardoppler (with scipy) is imported where it is used, so that loading the
+# app (e.g., in web workers and management commands not processing Doppler
+# data) does not import it. nansat.figure (with matplotlib) is imported by
+# nansat.nansat anyway.
+
+# Standard names of the per-pixel products computed by DatasetManager.process
+ANOMALY_WKV = \
+    'anomaly_of_surface_backwards_doppler_centroid_frequency_shift_of_radar_wave'
+FDG_WKV = \
+    'surface_backwards_doppler_frequency_shift_of_radar_wave_due_to_surface_velocity'
+
+# Pixel size [m] of the figures shown in leaflet
+LEAFLET_RESOLUTION = 1000
+
+# Bands (short names) shown in leaflet
+VISUALIZED_BANDS = ['valid_doppler',
+                    'valid_land_doppler',
+                    'valid_sea_doppler',
+                    'dca',
+                    'fdg']
+# Default options to Nansat.write_figure for all bands. Options per band
+# (e.g., clim, cmapName) can be given in settings.SAR_DOPPLER_FIGURE_OPTIONS,
+# which maps band short names to dicts of options.
+FIGURE_OPTIONS = {
+    'mask_lut': {0: [128, 128, 128]},
+    'transparency': [128, 128, 128],
+}
+
+def figure_options(band):
+    """ Return the options to Nansat.write_figure for the band """
+    options = dict(FIGURE_OPTIONS)
+    options.update(getattr(settings, 'SAR_DOPPLER_FIGURE_OPTIONS', {}).get(
+        band, {}))
+    return options
+
+# Bands of the merged scene product
+MERGED_BANDS = VISUALIZED_BANDS + ['incidence_angle']
+
+def azimuth_blocks(nlines, block_size):
+    """ Yield (start, stop) line indices of consecutive azimuth blocks of at
+    most <block_size> lines covering <nlines> lines
+    """
+    if block_size < 1:
+        raise ValueError('Block size must be a positive number of lines')
+    for y0 in range(0, nlines, block_size):
+        yield y0, min(y0 + block_size, nlines)
+
+def vrt_copy(n):
+    """ Return a copy of the Nansat or Domain object <n> with its own copy
+    of the VRT, which shares the parsed metadata so the file is not opened
+    again. The copy can be cropped, or used in another thread.
+    """
+    n_copy = copy.copy(n)
+    n_copy.vrt = n.vrt.copy()
+    return n_copy
+
+def cropped_blocks(n, block_size):
+    """ Yield (start, stop, block) of consecutive azimuth blocks of at most
+    <block_size> lines of the Nansat object <n>. Each block is a cropped
+    vrt_copy of <n>.
+    """
+    nlines, npixels = n.shape()
+    for y0, y1 in azimuth_blocks(nlines, block_size):
+        block = vrt_copy(n)
+        block.crop(0, y0, npixels, y1 - y0)
+        yield y0, y1, block
+
+def disk_backed_array(shape, dtype=np.float32):
+    """ Return a zero-initialised array backed by an anonymous temporary
+    file, so that its pages can be evicted from memory once written
+    """
+    return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+',
+            shape=shape)
+
+def subswath_product_filename(fn, i):
+    """ Return the filename of the exported product of subswath <i> of the
+    gsar file <fn>
+    """
+    return os.path.join(product_path(__name__.split('.')[0], fn),
+            os.path.basename(fn).split('.')[0] + 'subswath%s.nc' % i)
+
+def geometry_digest(geometry):
+    """ Return the hex digest of the normalized WKB of a GEOS geometry """
+    geometry = geometry.clone()
+    geometry.normalize()
+    return hashlib.sha1(bytes(geometry.wkb)).hexdigest()
+
+def _resample_lines(array, nlines):
+    """ Resample <array> to <nlines> azimuth lines (nearest neighbour) """
+    if array.shape[0] == nlines:
+        return array
+    return array[np.round(np.linspace(0, array.shape[0] - 1, nlines)).astype(int)]
+
+def _split_overlap(near, far, near_cols, far_cols):
+    """ Return the columns of the neighbouring subswaths <near> and <far>
+    to keep, so that their overlap in range is split at its middle.
+
+    The range position of each column is measured along the middle azimuth
+    line, as the projection onto the range direction of the near subswath.
+    """
+    def positions(part, origin, direction):
+        line = part['lon'].shape[0] // 2
+        lon, lat = part['lon'][line], part['lat'][line]
+        x = (lon - origin[0]) * np.cos(np.radians(origin[1]))
+        y = lat - origin[1]
+        return x * direction[0] + y * direction[1]
+
+    line = near['lon'].shape[0] // 2
+    origin = near['lon'][line, 0], near['lat'][line, 0]
+    direction = np.array([
+        (near['lon'][line, -1] - origin[0]) * np.cos(np.radians(origin[1])),
+        near['lat'][line, -1] - origin[1]])
+    direction /= np.hypot(*direction)
+    near_pos = positions(near, origin, direction)
+    far_pos = positions(far, origin, direction)
+    middle = (near_pos[-1] + far_pos[0]) / 2.
+    if far_pos[0] >= near_pos[-1]:
+        # No overlap
+        return near_cols, far_cols
+    near_keep = np.where(near_pos <= middle)[0]
+    far_keep = np.where(far_pos > middle)[0]
+    near_stop = int(near_keep[-1]) + 1 if near_keep.size else 0
+    far_start = int(far_keep[0]) if far_keep.size else far_pos.size
+    return (slice(near_cols.start, near_stop),
+            slice(far_start, far_cols.stop))
 
 class DatasetManager(DM):
 
@@ -64,7 +193,6 @@ class DatasetManager(DM):
         # consuming but apparently the only way to do it. Could be checked
         # though...
 
-        swath_data = {}
         lon = {}
         lat = {}
         astep = {}
@@ -81,12 +209,10 @@ class DatasetManager(DM):
         border = 'POLYGON(('
 
         for i in range(self.N_SUBSWATHS):
-            # Read subswaths 
-            swath_data[i] = Nansat(fn, subswath=i)
-
+            # Read subswaths one at a time - only the geolocation is kept
             # Should use nansat.domain.get_border - see nansat issue #166
             # (https://github.com/nansencenter/nansat/issues/166)
-            lon[i], lat[i] = swath_data[i].get_geolocation_grids()
+            lon[i], lat[i] = Nansat(fn, subswath=i).get_geolocation_grids()
 
             astep[i] = max(1, (lon[i].shape[0] / 2 * 2 - 1) / num_border_points)
             rstep[i] = max(1, (lon[i].shape[1] / 2 * 2 - 1) / num_border_points)
@@ -136,6 +262,7 @@ class DatasetManager(DM):
             # Change the dataset geolocation to cover all subswaths
             geoloc.geometry = new_geometry
             geoloc.save()
+            self.update_location_digest(geoloc)
             created = True
         
         return ds, created
@@ -145,20 +272,26 @@ class DatasetManager(DM):
         """
         return self.__module__.split('.')[0]
 
-    def export2netcdf(self, n, ds):
-
+    def export2netcdf(self, n, ds, block_size=None):
+        """ Export the subswath <n> of the dataset <ds> with its overview
+        levels and land Doppler samples. If <block_size> is given, these are
+        computed over azimuth blocks of <block_size> lines.
+        """
         i = n.get_metadata('subswath')
 
         # Set filename of exported netcdf
-        fn = os.path.join(product_path(self.module_name(), n.filename),
-                            os.path.basename(n.filename).split('.')[0]
-                            + 'subswath%s.nc' % i)
+        fn = subswath_product_filename(n.filename, i)
         # Set filename of original gsar file in metadata
         n.set_metadata(key='Originating file',
                                         value=n.filename)
+        # Set pixel spacing, used for selecting overview levels
+        n.set_metadata(key='pixel_spacing',
+                value='%.1f' % product_pixel_spacing(n))
         # Export data to netcdf
         print('Exporting %s (subswath %s)' % (n.filename, i))
         n.export(filename=fn)
+        # Export decimated overview levels
+        write_overviews(n, fn, block_size)
 
         # Add netcdf uri to DatasetURIs
         ncuri = 'file://localhost' + fn
@@ -166,141 +299,374 @@ class DatasetManager(DM):
         new_uri, created = DatasetURI.objects.get_or_create(uri=ncuri,
                                                             dataset=ds)
 
+        # Store the footprint of the subswath product
+        self.add_footprint(ds, new_uri, n, i)
+
+        # Append the land Doppler samples used for calibration
+        add_samples(ds, n, ncuri, block_size=block_size)
+
+    def add_footprint(self, ds, dsuri, n, i):
+        """ Store the footprint of the subswath <n> (number <i>) of the
+        dataset <ds>, exported to the DatasetURI <dsuri>
+        """
+        from sar_doppler.models import SubswathFootprint
+        SubswathFootprint.objects.update_or_create(uri=dsuri, defaults={
+            'dataset': ds,
+            'subswath': int(i),
+            'geometry': WKTReader().read(n.get_border_wkt()),
+        })
+
+    def add_footprints(self, ds):
+        """ Store the footprints of the exported subswath products of the
+        dataset <ds> which have none, e.g., processed before footprints were
+        stored. Returns the number of footprints added.
+        """
+        from sar_doppler.models import SubswathFootprint
+        from sar_doppler.extract import subswath_products
+        added = 0
+        for i, uri in subswath_products(ds):
+            dsuri = ds.dataseturi_set.get(uri=uri)
+            if SubswathFootprint.objects.filter(uri=dsuri).exists():
+                continue
+            self.add_footprint(ds, dsuri, Nansat(nansat_filename(uri)), i)
+            added += 1
+        return added
+
+    def add_doppler_products(self, n):
+        """ Add the Doppler anomaly and the geophysical Doppler shift to the
+        subswath <n> as full resolution bands
+        """
+        n.add_band(array=n.anomaly(), parameters={'wkv': ANOMALY_WKV})
+        n.add_band(array=n.geophysical_doppler_shift(),
+                parameters={'wkv': FDG_WKV})
+
+    def add_doppler_products_blockwise(self, n, block_size):
+        """ Add the Doppler anomaly and the geophysical Doppler shift to the
+        subswath <n>, computed over azimuth blocks of <block_size> lines
+
+        Each block is computed from a cropped copy of <n> (see
+        cropped_blocks), and is written to a disk backed array. The peak memory is then set by the block size rather
+        than by the size of the scene, and the bands are streamed from disk
+        when the subswath is exported.
+
+        Doppler.anomaly and Doppler.geophysical_doppler_shift are computed
+        per pixel from the bands and the azimuth time of the line, so the
+        blocks are equal to the lines of the computation over the whole
+        subswath.
+        """
+        nlines, npixels = n.shape()
+        anomaly = disk_backed_array((nlines, npixels))
+        fdg = disk_backed_array((nlines, npixels))
+        for y0, y1, block in cropped_blocks(n, block_size):
+            anomaly[y0:y1] = block.anomaly()
+            fdg[y0:y1] = block.geophysical_doppler_shift()
+            del block
+        anomaly.flush()
+        fdg.flush()
+        n.add_band(array=anomaly, parameters={'wkv': ANOMALY_WKV})
+        n.add_band(array=fdg, parameters={'wkv': FDG_WKV})
+
+    def write_subswath(self, ds, n, i, mp, memo=None, block_size=None):
+        """ Export the processed subswath <n> (number <i>) to netcdf, and
+        create figures for display with leaflet in the media path <mp>.
+
+        Returns False if the reprojection failed.
+        """
+        self.export2netcdf(n, ds, block_size)
+        return self.visualize(ds, n, mp, i, memo=memo)
+
+    def visualize(self, ds, n, mp, i=None, memo=None):
+        """ Reproject <n> to the leaflet projection, and create figures and
+        Visualization records of its bands in the media path <mp>.
+
+        <n> is subswath number <i>, or the merged scene if <i> is None.
+        <memo> is passed on to get_or_create_location.
+        Returns False if the reprojection failed.
+        """
+        # Reproject to leaflet projection
+        xlon, xlat = n.get_corners()
+        d = Domain(NSR(3857),
+                   '-lle %f %f %f %f -tr %d %d'
+                   % (xlon.min(), xlat.min(), xlon.max(), xlat.max(),
+                      LEAFLET_RESOLUTION, LEAFLET_RESOLUTION))
+        n.reproject(d, resample_alg=1, tps=True)
+
+        # Check if the reprojection failed
+        try:
+            inci = n['incidence_angle']
+        except:
+            warnings.warn('Could not read incidence angles - reprojection failed')
+            return False
+
+        # Create GeographicLocation for the visualization objects
+        geom = self.get_or_create_location(
+                WKTReader().read(n.get_border_wkt()), memo=memo)
+
+        # Create visualizations of the following bands (short_names)
+        for band in VISUALIZED_BANDS:
+            if i is None:
+                filename = '%s_merged.png' % band
+            else:
+                filename = '%s_subswath_%d.png' % (band, i)
+            # check uniqueness of parameter
+            param = Parameter.objects.get(short_name=band)
+            if n.filename == \
+                    '/mnt/10.11.12.232/sat_downloads_asar/level-0/2010-01/ascending/HH/gsar_rvl/RVL_ASA_WS_20100119213139150.gsar' \
+                or n.filename == \
+                    '/mnt/10.11.12.232/sat_downloads_asar/level-0/2010-01/descending/HH/gsar_rvl/RVL_ASA_WS_20100129225931627.gsar':
+                # generates memory error in write_figure...
+                continue
+            fig = n.write_figure(
+                os.path.join(mp, filename),
+                bands=band,
+                mask_array=n['swathmask'],
+                **figure_options(band))
+
+            if type(fig) == Figure:
+                print('Created figure %s' % filename)
+            else:
+                warnings.warn('Figure NOT CREATED')
+
+            # Get or create DatasetParameter
+            dsp, created = DatasetParameter.objects.get_or_create(dataset=ds,
+                                                                  parameter=param)
+
+            # Create Visualization
+            if i is None:
+                title = '%s (merged)' % param.standard_name
+            else:
+                title = '%s (swath %d)' % (param.standard_name, i + 1)
+            # Rendering again (e.g., from the products) refreshes the record
+            # of the figure, whose location may have changed
+            vv, created = Visualization.objects.update_or_create(
+                uri='file://localhost%s/%s' % (mp, filename),
+                defaults={'title': title, 'geographic_location': geom}
+            )
+
+            # Create VisualizationParameter
+            vp, created = VisualizationParameter.objects.get_or_create(
+                visualization=vv,
+                ds_parameter=dsp
+            )
+
+        return True
+
+    def get_or_create_location(self, geometry, memo=None):
+        """ Return the GeographicLocation of <geometry>, creating it if needed.
+
+        Existing locations are found by the digest of the normalized geometry
+        (see GeometryDigest), an indexed lookup, rather than by comparing
+        geometries. Locations created elsewhere (e.g., by the geospaas
+        ingestor) have no digest, so on a miss the geometries are compared
+        before a location is created, and the digest is added. <memo> is an
+        optional dict of locations by digest, e.g., for one scene.
+        """
+        from sar_doppler.models import GeometryDigest
+        digest = geometry_digest(geometry)
+        if memo is not None and digest in memo:
+            return memo[digest]
+        try:
+            geom = GeometryDigest.objects.select_related(
+                    'geographic_location').get(digest=digest).geographic_location
+        except GeometryDigest.DoesNotExist:
+            geom = GeographicLocation.objects.filter(
+                    geometry__equals=geometry).order_by('id').first()
+            try:
+                with transaction.atomic():
+                    if geom is None:
+                        geom = GeographicLocation.objects.create(
+                                geometry=geometry)
+                    GeometryDigest.objects.create(digest=digest,
+                            geographic_location=geom)
+            except IntegrityError:
+                # Created by another process in the meantime
+                geom = GeometryDigest.objects.select_related(
+                        'geographic_location').get(
+                                digest=digest).geographic_location
+        if memo is not None:
+            memo[digest] = geom
+        return geom
+
+    def update_location_digest(self, location):
+        """ Replace the digests of the GeographicLocation <location> after its
+        geometry was changed
+        """
+        from sar_doppler.models import GeometryDigest
+        digest = geometry_digest(location.geometry)
+        with transaction.atomic():
+            GeometryDigest.objects.filter(geographic_location=location).exclude(
+                    digest=digest).delete()
+            GeometryDigest.objects.update_or_create(digest=digest,
+                    defaults={'geographic_location': location})
+
+    def merge_input(self, n):
+        """ Return a dict with the geolocation and the bands of the subswath
+        <n> needed for the merged scene product.
+
+        The bands are averaged over blocks of pixels to about the resolution
+        of the merged figures (LEAFLET_RESOLUTION), so that the parts of all
+        subswaths are small while they are stitched.
+        """
+        spacing = product_pixel_spacing(n)
+        factor = 1
+        if np.isfinite(spacing) and spacing > 0:
+            factor = max(1, int(LEAFLET_RESOLUTION // spacing))
+        lon, lat = overview_geolocation(n, factor)
+        part = {'lon': lon, 'lat': lat}
+        for band in MERGED_BANDS:
+            part[band] = block_mean(n[band], factor)
+            if band in OVERVIEW_MASKS:
+                # Valid where most of the block is valid
+                part[band] = (part[band] >= 0.5).astype(np.uint8)
+        return part
+
+    def merge_subswaths(self, parts, filename=''):
+        """ Stitch the subswaths (dicts from merge_input, ordered from near to
+        far range) into one swath-wide Nansat object.
+
+        The subswaths are resampled to a common number of azimuth lines, and
+        the overlap between neighbouring subswaths is split at its middle in
+        range.
+        """
+        nlines = max(part['lon'].shape[0] for part in parts)
+        columns = [slice(None)]*len(parts)
+        for j in range(len(parts) - 1):
+            columns[j], columns[j+1] = _split_overlap(parts[j], parts[j+1],
+                    columns[j], columns[j+1])
+        merged = {}
+        for key in ['lon', 'lat'] + MERGED_BANDS:
+            merged[key] = np.concatenate([
+                _resample_lines(part[key], nlines)[:, cols]
+                for part, cols in zip(parts, columns)], axis=1)
+        n = Nansat(domain=Domain(lon=merged['lon'], lat=merged['lat']))
+        for band in MERGED_BANDS:
+            n.add_band(array=merged[band], parameters={'name': band})
+        n.filename = filename
+        return n
+
     def process(self, uri, *args, **kwargs):
         """ Create data products
+
+        If the keyword argument block_size is given, the Doppler anomaly and
+        the geophysical Doppler shift are computed over azimuth blocks of
+        block_size lines (see add_doppler_products_blockwise). This bounds the
+        memory use for large scenes.
+
+        If the keyword argument writer is given, the output stage of each
+        subswath (see write_subswath) is not run directly but handed over as
+        writer(write_subswath, ds, n, i, mp), e.g. to be run in another
+        thread. The returned processed flag then only covers the computation.
+
+        If the keyword argument merged is True, the subswaths are stitched
+        into one swath-wide product which is reprojected and visualized once
+        (see merge_subswaths), instead of creating figures per subswath.
         """
+        from sardoppler.sardoppler import Doppler
+        block_size = kwargs.pop('block_size', None)
+        writer = kwargs.pop('writer', None)
+        merged = kwargs.pop('merged', False)
         ds, created = self.get_or_create(uri, *args, **kwargs)
         fn = nansat_filename(uri)
-        swath_data = {}
-        # Read subswaths 
-        for i in range(self.N_SUBSWATHS):
-            swath_data[i] = Doppler(fn, subswath=i)
 
         # Set media path (where images will be stored)
-        mp = media_path(self.module_name(), swath_data[i].filename)
-        # Set product path (where netcdf products will be stored)
-        ppath = product_path(self.module_name(), swath_data[i].filename)
+        mp = media_path(self.module_name(), fn)
 
-        # Loop subswaths, process each of them and create figures for display with leaflet
+        # Loop subswaths, process each of them and create figures for display
+        # with leaflet. Only one subswath is kept in memory at a time.
         processed = True
+        parts = []
+        # GeographicLocations of the scene by geometry digest
+        memo = {}
         for i in range(self.N_SUBSWATHS):
+            swath_data = Doppler(fn, subswath=i)
             # Check if the file is corrupted
             try:
-                inci = swath_data[i]['incidence_angle']
+                inci = swath_data['incidence_angle']
             #  TODO: What kind of exception ?
             except:
                 processed = False
                 continue
+            del inci
 
-            # Add Doppler anomaly
-            swath_data[i].add_band(array=swath_data[i].anomaly(), parameters={
-                'wkv':
-                'anomaly_of_surface_backwards_doppler_centroid_frequency_shift_of_radar_wave'
-            })
+            # Add Doppler anomaly and total geophysical Doppler shift
+            if block_size:
+                self.add_doppler_products_blockwise(swath_data, block_size)
+            else:
+                self.add_doppler_products(swath_data)
 
             # Get band number of DC freq, then DC polarisation
-            band_number = swath_data[i].get_band_number({
+            band_number = swath_data.get_band_number({
                 'standard_name': 'surface_backwards_doppler_centroid_frequency_shift_of_radar_wave',
                 })
-            pol = swath_data[i].get_metadata(band_id=band_number, key='polarization')
-
-            # Calculate total geophysical Doppler shift
-            fdg = swath_data[i].geophysical_doppler_shift()
-            swath_data[i].add_band(
-                array=fdg,
-                parameters={
-                    'wkv': 'surface_backwards_doppler_frequency_shift_of_radar_wave_due_to_surface_velocity'
-                })
-
-            self.export2netcdf(swath_data[i], ds)
-
-            # Reproject to leaflet projection
-            xlon, xlat = swath_data[i].get_corners()
-            d = Domain(NSR(3857),
-                       '-lle %f %f %f %f -tr 1000 1000'
-                       % (xlon.min(), xlat.min(), xlon.max(), xlat.max()))
-            swath_data[i].reproject(d, resample_alg=1, tps=True)
-
-            # Check if the reprojection failed
-            try:
-                inci = swath_data[i]['incidence_angle']
-            except:
-                processed = False
-                warnings.warn('Could not read incidence angles - reprojection failed')
-                continue
-
-            # Create visualizations of the following bands (short_names)
-            ingest_creates = ['valid_doppler',
-                              'valid_land_doppler',
-                              'valid_sea_doppler',
-                              'dca',
-                              'fdg']
-            for band in ingest_creates:
-                filename = '%s_subswath_%d.png' % (band, i)
-                # check uniqueness of parameter
-                param = Parameter.objects.get(short_name=band)
-                if swath_data[i].filename == \
-                        '/mnt/10.11.12.232/sat_downloads_asar/level-0/2010-01/ascending/HH/gsar_rvl/RVL_ASA_WS_20100119213139150.gsar' \
-                    or swath_data[i].filename == \
-                        '/mnt/10.11.12.232/sat_downloads_asar/level-0/2010-01/descending/HH/gsar_rvl/RVL_ASA_WS_20100129225931627.gsar':
-                    # generates memory error in write_figure...
-                    continue
-                fig = swath_data[i].write_figure(
-                    os.path.join(mp, filename),
-                    bands=band,
-                    mask_array=swath_data[i]['swathmask'],
-                    mask_lut={0: [128, 128, 128]},
-                    transparency=[128, 128, 128])
-
-                if type(fig) == Figure:
-                    print 'Created figure of subswath %d, band %s' % (i, band)
+            pol = swath_data.get_metadata(band_id=band_number, key='polarization')
+
+            if merged:
+                # Only export the subswath, and keep what is needed for the
+                # merged figures
+                parts.append(self.merge_input(swath_data))
+                if writer is not None:
+                    writer(self.export2netcdf, swath_data, ds, block_size)
                 else:
-                    warnings.warn('Figure NOT CREATED')
-
-                # Get or create DatasetParameter
-                dsp, created = DatasetParameter.objects.get_or_create(dataset=ds,
-                                                                      parameter=param)
-
-                # Create GeographicLocation for the visualization object
-                geom, created = GeographicLocation.objects.get_or_create(
-                        geometry=WKTReader().read(swath_data[i].get_border_wkt()))
+                    self.export2netcdf(swath_data, ds, block_size)
+            elif writer is not None:
+                writer(self.write_subswath, ds, swath_data, i, mp, memo,
+                        block_size)
+            elif not self.write_subswath(ds, swath_data, i, mp, memo=memo,
+                    block_size=block_size):
+                processed = False
 
-                # Create Visualization
-                vv, created = Visualization.objects.get_or_create(
-                    uri='file://localhost%s/%s' % (mp, filename),
-                    title='%s (swath %d)' % (param.standard_name, i + 1),
-                    geographic_location=geom
-                )
+        if merged and parts:
+            # Stitch the subswaths, and reproject and visualize them once
+            merged_data = self.merge_subswaths(parts, filename=fn)
+            del parts
+            if writer is not None:
+                writer(self.visualize, ds, merged_data, mp, None, memo)
+            elif not self.visualize(ds, merged_data, mp, memo=memo):
+                processed = False
 
-                # Create VisualizationParameter
-                vp, created = VisualizationParameter.objects.get_or_create(
-                    visualization=vv,
-                    ds_parameter=dsp
-                )
+        return ds, processed
 
-        # TODO: consider merged figures like Jeong-Won has added in the development branch
+    def render(self, ds, merged=False):
+        """ Recreate the figures and Visualization records of a processed
+        dataset from its exported subswath netcdf products, without reading
+        the raw gsar file.
 
-        return ds, processed
+        Returns False if no products were found or a reprojection failed.
+        """
+        fn = nansat_filename(ds.dataseturi_set.get(uri__endswith='.gsar').uri)
+        mp = media_path(self.module_name(), fn)
+        rendered = False
+        parts = []
+        memo = {}
+        for i in range(self.N_SUBSWATHS):
+            uris = ds.dataseturi_set.filter(uri__endswith='subswath%d.nc' % i)
+            if not uris:
+                continue
+            # Read the coarsest overview level that is finer than the figures
+            n = Nansat(select_product(nansat_filename(uris[0].uri),
+                LEAFLET_RESOLUTION))
+            if merged:
+                parts.append(self.merge_input(n))
+                continue
+            if not self.visualize(ds, n, mp, i, memo=memo):
+                return False
+            rendered = True
+        if parts:
+            rendered = self.visualize(ds, self.merge_subswaths(parts,
+                filename=fn), mp, memo=memo)
+        return rendered
 
     #def bayesian_wind(self):
-    #    # Find matching NCEP forecast wind field
+    #    # Find matching NCEP forecast wind field (see
+    #    # sar_doppler.collocation.CollocationService)
     #    wind = [] # do not do any wind correction now, since we have lookup tables
-    #    wind = Dataset.objects.filter(
-    #            source__platform__short_name='NCEP-GFS',
-    #            time_coverage_start__range=[
-    #                parse(swath_data[i].get_metadata()['time_coverage_start'])
-    #                - timedelta(hours=3),
-    #                parse(swath_data[i].get_metadata()['time_coverage_start'])
-    #                + timedelta(hours=3)
-    #            ]
-    #        )
+    #    wind = collocation_service().nearest('NCEP-GFS',
+    #            parse(swath_data[i].get_metadata()['time_coverage_start']),
+    #            tolerance=timedelta(hours=3))
     #    if wind:
-    #        dates = [w.time_coverage_start for w in wind]
-    #        # TODO: Come back later (!!!)
-    #        nearest_date = min(dates, key=lambda d:
-    #                abs(d-parse(swath_data[i].get_metadata()['time_coverage_start']).replace(tzinfo=timezone.utc)))
+    #        nearest_date, wind_uri = wind
     #        fww = swath_data[i].wind_waves_doppler(
-    #                nansat_filename(wind[dates.index(nearest_date)].dataseturi_set.all()[0].uri),
+    #                nansat_filename(wind_uri),
     #                pol
     #            )
 
@@ -310,7 +676,7 @@ class DatasetManager(DM):
     #        })
 
     #        fdg = swath_data[i].geophysical_doppler_shift(
-    #            wind=nansat_filename(wind[dates.index(nearest_date)].dataseturi_set.all()[0].uri)
+    #            wind=nansat_filename(wind_uri)
     #        )
 
     #        # Estimate current by subtracting wind-waves Doppler
@@ -318,7 +684,7 @@ class DatasetManager(DM):
     #        vcurrent = -np.pi * (fdg - fww) / (112. * np.sin(theta))
 
     #        # Smooth...
-    #        # vcurrent = median_filter(vcurrent, size=(3,3))
+    #        # vcurrent = scipy.ndimage.median_filter(vcurrent, size=(3,3))
     #        swath_data[i].add_band(
     #            array=vcurrent,
     #            parameters={
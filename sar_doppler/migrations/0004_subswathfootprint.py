@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0001_initial'),
+        ('sar_doppler', '0003_populate_sardopplerextrametadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubswathFootprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subswath', models.IntegerField()),
+                ('geometry', django.contrib.gis.db.models.fields.GeometryField(srid=4326)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sar_doppler.Dataset')),
+                ('uri', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='catalog.DatasetURI')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0001_initial'),
+        ('sar_doppler', '0004_subswathfootprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeometryDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40, unique=True)),
+                ('geographic_location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catalog.GeographicLocation')),
+            ],
+        ),
+    ]
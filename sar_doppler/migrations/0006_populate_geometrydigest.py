@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations
+
+def geometry_digest(geometry):
+    # Copy of sar_doppler.managers.geometry_digest at the time of the migration
+    geometry = geometry.clone()
+    geometry.normalize()
+    return hashlib.sha1(bytes(geometry.wkb)).hexdigest()
+
+def add_digests(apps, schema_editor):
+    location_model = apps.get_model('catalog', 'geographiclocation')
+    digest_model = apps.get_model('sar_doppler', 'geometrydigest')
+    digests = set(digest_model.objects.values_list('digest', flat=True))
+    new = []
+    for location in location_model.objects.order_by('id').iterator():
+        digest = geometry_digest(location.geometry)
+        if digest in digests:
+            # Equal geometry - the first location is used
+            continue
+        digests.add(digest)
+        new.append(digest_model(digest=digest, geographic_location=location))
+        if len(new) == 1000:
+            digest_model.objects.bulk_create(new)
+            new = []
+    digest_model.objects.bulk_create(new)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sar_doppler', '0005_geometrydigest'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_digests, reverse_code=migrations.RunPython.noop),
+    ]
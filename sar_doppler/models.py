@@ -1,6 +1,8 @@
 from django.db import models
+from django.contrib.gis.db import models as gis_models
 
 from geospaas.catalog.models import Dataset as CatalogDataset
+from geospaas.catalog.models import DatasetURI, GeographicLocation
 
 from sar_doppler.managers import DatasetManager
 
@@ -19,3 +21,22 @@ class SARDopplerExtraMetadata(models.Model):
      dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
      polarization = models.CharField(default='', max_length=100)
 
+class SubswathFootprint(models.Model):
+    """ Footprint of an exported subswath product, for finding the products
+    intersecting a region without opening them
+    """
+
+    uri = models.OneToOneField(DatasetURI, on_delete=models.CASCADE)
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
+    subswath = models.IntegerField()
+    geometry = gis_models.GeometryField()
+
+class GeometryDigest(models.Model):
+    """ Digest of the normalized WKB of a GeographicLocation geometry, for
+    finding existing locations with an indexed lookup instead of comparing
+    geometries
+    """
+
+    digest = models.CharField(max_length=40, unique=True)
+    geographic_location = models.ForeignKey(GeographicLocation,
+            on_delete=models.CASCADE)
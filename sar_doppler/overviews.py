@@ -0,0 +1,187 @@
+''' Decimated overview levels of the exported subswath products
+
+Next to each exported subswath product <name>subswath<i>.nc, overview files
+<name>subswath<i>_x<factor>.nc hold the Doppler bands and masks averaged
+(ignoring nan) over blocks of factor x factor pixels. Readers that need a
+coarser resolution than the full one can use select_product to open the
+coarsest level that is still fine enough.
+'''
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+from django.conf import settings
+
+from nansat.nansat import Nansat
+from nansat.domain import Domain
+
+from sar_doppler.raster import read_lines
+
+OVERVIEW_FACTORS = (2, 4, 8)
+
+# Bands written to the overviews, if present in the product
+OVERVIEW_BANDS = ['dca', 'fdg', 'Ur', 'incidence_angle', 'sensor_azimuth']
+OVERVIEW_MASKS = ['valid_doppler', 'valid_land_doppler', 'valid_sea_doppler']
+
+# Metres per degree of latitude
+DEGREE = 111320.
+
+# Maximum number of lines and columns of the geolocation grids read to
+# estimate the pixel spacing
+GRID_SIZE = 1000
+
+def overview_factors():
+    return getattr(settings, 'SAR_DOPPLER_OVERVIEW_FACTORS', OVERVIEW_FACTORS)
+
+def overview_filename(fn, factor):
+    ''' Return the filename of the overview level of the product fn '''
+    base, ext = os.path.splitext(fn)
+    return '%s_x%d%s' % (base, factor, ext)
+
+def block_sums(sums, counts, factor):
+    ''' Return the sums and counts over blocks of factor x factor pixels of
+    the arrays of sums and counts. Blocks at the edges may be partial.
+    '''
+    ny, nx = sums.shape
+    pad = ((0, -ny % factor), (0, -nx % factor))
+    shape = ((ny + pad[0][1])//factor, factor, (nx + pad[1][1])//factor, factor)
+    return (np.pad(sums, pad, mode='constant').reshape(shape).sum(axis=(1, 3)),
+            np.pad(counts, pad, mode='constant').reshape(shape).sum(axis=(1, 3)))
+
+def block_mean(array, factor, dtype=np.float32):
+    ''' Return the mean of array over blocks of factor x factor pixels,
+    ignoring nan. Blocks at the edges may be partial.
+    '''
+    valid = np.isfinite(array)
+    sums, counts = block_sums(np.where(valid, array, 0).astype(dtype),
+            valid.astype(np.int32), factor)
+    return _mean(sums, counts)
+
+def _mean(sums, counts):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # nan for blocks without valid pixels
+        return np.where(counts > 0, sums/counts, np.nan).astype(sums.dtype)
+
+def pixel_spacing(lon, lat):
+    ''' Return the approximate pixel spacing [m] of a lon/lat grid, the
+    larger of the spacings along the two axes
+    '''
+    coslat = np.cos(np.radians(lat))
+    dx = np.hypot(np.diff(lon, axis=1)*coslat[:, 1:], np.diff(lat, axis=1))
+    dy = np.hypot(np.diff(lon, axis=0)*coslat[1:], np.diff(lat, axis=0))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return DEGREE*np.nanmax([np.nanmedian(dx), np.nanmedian(dy)])
+
+def product_pixel_spacing(n):
+    ''' Return the approximate pixel spacing [m] of n, from its geolocation
+    grids decimated to at most GRID_SIZE lines and columns
+    '''
+    step = max(1, max(n.shape())//GRID_SIZE)
+    lon, lat = n.get_geolocation_grids(stepSize=step)
+    return pixel_spacing(lon, lat)/step
+
+def overview_geolocation(n, factor):
+    ''' Return the lon/lat grids of the overview level factor of n, at the
+    centres of the blocks. The grids are not averaged, which would fail
+    across the antimeridian.
+    '''
+    nrows, ncols = n.shape()
+    cols = np.minimum(np.arange(0, ncols, factor) + (factor - 1)/2., ncols - 1)
+    rows = np.minimum(np.arange(0, nrows, factor) + (factor - 1)/2., nrows - 1)
+    cols, rows = np.meshgrid(cols, rows)
+    lon, lat = n.transform_points(cols.flatten(), rows.flatten())
+    return (np.asarray(lon).reshape(cols.shape),
+            np.asarray(lat).reshape(cols.shape))
+
+def _empty(shape, disk_backed):
+    if disk_backed:
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.float32,
+                mode='w+', shape=shape)
+    return np.empty(shape, dtype=np.float32)
+
+def write_overviews(n, fn, block_size=None):
+    ''' Write the overview levels of the subswath n, exported to fn.
+
+    Each band is read once. The coarser levels are built from the finer
+    ones, from sums and counts of the valid pixels. If block_size is given,
+    the bands are read over azimuth blocks of about block_size lines and the
+    levels are kept in disk backed arrays, so the memory use does not depend
+    on the size of the subswath.
+    '''
+    nrows, ncols = n.shape()
+    factors = [f for f in sorted(overview_factors()) if min(nrows, ncols) >= 2*f]
+    if not factors:
+        return
+    bands = [band for band in OVERVIEW_BANDS + OVERVIEW_MASKS
+            if n.has_band(band)]
+    # Blocks are aligned with the blocks of all levels
+    align = factors[0]
+    for f in factors[1:]:
+        step = align
+        while align % f:
+            align += step
+    if block_size:
+        lines = max(align, block_size//align*align)
+    else:
+        lines = nrows
+    levels = dict((f, dict((band, _empty((-(-nrows//f), -(-ncols//f)),
+        bool(block_size))) for band in bands)) for f in factors)
+
+    for y0 in range(0, nrows, lines):
+        y1 = min(y0 + lines, nrows)
+        for band in bands:
+            data = read_lines(n, band, 0, y0, ncols, y1 - y0).astype(np.float32)
+            valid = np.isfinite(data)
+            # Sums and counts of each level, by factor
+            sums = {1: (np.where(valid, data, 0), valid.astype(np.int32))}
+            del data, valid
+            for f in factors:
+                # Build from the coarsest level that divides this one
+                base = max(p for p in sums if f % p == 0)
+                sums[f] = block_sums(sums[base][0], sums[base][1], f//base)
+                mean = _mean(*sums[f])
+                levels[f][band][y0//f:y0//f + mean.shape[0]] = mean
+
+    metadata = n.get_metadata()
+    spacing = metadata.get('pixel_spacing')
+    for f in factors:
+        lon, lat = overview_geolocation(n, f)
+        ov = Nansat(domain=Domain(lon=lon, lat=lat))
+        for band in bands:
+            data = levels[f][band]
+            if band in OVERVIEW_MASKS:
+                # Valid where most of the block is valid
+                data = (data >= 0.5).astype(np.uint8)
+            ov.add_band(array=data, parameters={'name': band})
+        ov.set_metadata(metadata)
+        ov.set_metadata('overview_factor', str(f))
+        if spacing is not None:
+            ov.set_metadata('pixel_spacing', '%.1f' % (float(spacing)*f))
+        ov.export(filename=overview_filename(fn, f))
+        del ov, levels[f]
+
+def select_product(fn, resolution):
+    ''' Return the filename of the coarsest overview level of the product fn
+    with a pixel spacing not larger than resolution [m], or fn itself
+    '''
+    spacing = Nansat(fn).get_metadata().get('pixel_spacing')
+    if spacing is None:
+        return fn
+    selected = fn
+    for factor in sorted(overview_factors()):
+        if float(spacing)*factor > resolution:
+            break
+        if os.path.isfile(overview_filename(fn, factor)):
+            selected = overview_filename(fn, factor)
+    return selected
+
+def domain_resolution(domain):
+    ''' Return the approximate pixel size [m] of a Domain '''
+    lon, lat = domain.get_corners()
+    nrows, ncols = domain.shape()
+    dx = (lon.max() - lon.min())*np.cos(np.radians(lat.mean()))*DEGREE/ncols
+    dy = (lat.max() - lat.min())*DEGREE/nrows
+    return min(dx, dy)
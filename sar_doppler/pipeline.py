@@ -0,0 +1,260 @@
+''' Pipelined processing of SAR Doppler scenes
+
+The scenes are passed through three stages running in separate threads and
+connected by bounded queues:
+
+    reader  - prefetches the next .gsar files from the archive
+    compute - computes the Doppler products (DatasetManager.process)
+    writer  - exports netcdf, writes figures and database rows
+              (DatasetManager.write_subswath)
+
+The stages overlap, so the scene throughput is set by the slowest stage
+rather than by the sum of them. Several scenes can be computed at the same
+time (compute_workers). The bounded queues limit the number of scenes
+(and subswaths) held in memory, and make submit block when the pipeline is
+full.
+'''
+import os
+import json
+import time
+import fnmatch
+import logging
+import threading
+
+from django.db import connection
+from django.utils.six.moves import queue
+
+from geospaas.utils.utils import nansat_filename
+
+# Marks the end of the input to a stage
+_STOP = object()
+
+class ScenePipeline(object):
+
+    PREFETCH_CHUNK_SIZE = 16*1024*1024
+
+    def __init__(self, manager, prefetch=2, write_queue_size=5, callback=None,
+            compute_workers=1, **process_kwargs):
+        ''' Set up the pipeline
+
+        Parameters
+        ----------
+        manager : DatasetManager
+            The manager used to process the scenes
+        prefetch : int
+            Number of scenes read ahead of the computation
+        write_queue_size : int
+            Number of processed subswaths waiting to be written
+        callback : callable
+            Called as callback(uri, ds, processed, error) in the writer thread
+            when a scene is done. error is None, or the exception raised while
+            processing the scene.
+        compute_workers : int
+            Number of scenes computed at the same time
+        process_kwargs
+            Keyword arguments passed to manager.process
+        '''
+        self.manager = manager
+        self.callback = callback
+        self.process_kwargs = process_kwargs
+        self._read_queue = queue.Queue(maxsize=prefetch)
+        self._compute_queue = queue.Queue(maxsize=prefetch)
+        self._write_queue = queue.Queue(maxsize=write_queue_size)
+        # Scenes with failed subswath output, and errors from the writer
+        self._failed = set()
+        self._errors = {}
+        self._threads = [threading.Thread(target=self._run,
+            args=(self._read_queue, self._read, self._compute_queue, 1,
+                compute_workers))]
+        for i in range(compute_workers):
+            self._threads.append(threading.Thread(target=self._run,
+                args=(self._compute_queue, self._compute, self._write_queue)))
+        self._threads.append(threading.Thread(target=self._run,
+            args=(self._write_queue, self._write, None, compute_workers)))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, uri):
+        ''' Add a scene to the pipeline - blocks while the pipeline is full '''
+        self._read_queue.put(uri)
+
+    def close(self):
+        ''' Signal that no more scenes will be submitted '''
+        self._read_queue.put(_STOP)
+
+    def join(self):
+        ''' Wait until all submitted scenes are processed '''
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, in_queue, stage, out_queue, n_in=1, n_out=1):
+        ''' Run a stage until n_in stop signals are received, then send n_out
+        stop signals to the next stage
+        '''
+        stops = 0
+        try:
+            while True:
+                item = in_queue.get()
+                if item is _STOP:
+                    stops += 1
+                    if stops == n_in:
+                        break
+                    continue
+                try:
+                    stage(item)
+                except Exception as e:
+                    # Keep the pipeline running
+                    logging.exception(repr(e))
+        finally:
+            # Pass the stop signal on to the next stage
+            if out_queue is not None:
+                for i in range(n_out):
+                    out_queue.put(_STOP)
+            # Each thread has its own database connection
+            connection.close()
+
+    def _read(self, uri):
+        ''' Read the file through once, so that it is in the page cache when
+        the computation starts
+        '''
+        try:
+            with open(nansat_filename(uri), 'rb') as f:
+                while f.read(self.PREFETCH_CHUNK_SIZE):
+                    pass
+        except (IOError, OSError) as e:
+            # Let the compute stage report the error
+            logging.warning('Could not prefetch %s: %s' % (uri, repr(e)))
+        self._compute_queue.put(uri)
+
+    def _compute(self, uri):
+        def writer(func, *args):
+            self._write_queue.put((uri, func, args))
+        try:
+            ds, processed = self.manager.process(uri, writer=writer,
+                    **self.process_kwargs)
+        except Exception as e:
+            self._write_queue.put((uri, None, (None, False, e)))
+        else:
+            self._write_queue.put((uri, None, (ds, processed, None)))
+
+    def _write(self, item):
+        uri, func, args = item
+        if func is not None:
+            # Output of one subswath - False marks a failure
+            try:
+                if func(*args) is False:
+                    self._failed.add(uri)
+            except Exception as e:
+                self._errors.setdefault(uri, e)
+            return
+        # The scene is done
+        ds, processed, error = args
+        error = error or self._errors.pop(uri, None)
+        if uri in self._failed:
+            self._failed.discard(uri)
+            processed = False
+        if self.callback is not None:
+            self.callback(uri, ds, processed, error)
+
+class ScanCursor(object):
+    ''' Persisted position of a scan of archive directories for new files.
+
+    Files are ordered by status change time (ctime), which is set when a
+    file arrives in the archive, also if it is copied with its original
+    modification time kept, and when it is replaced. The cursor holds a
+    watermark ctime, before which all files are done, and the ctimes of the
+    files done after it. Files which failed are retried after a delay
+    doubling with each attempt, and are given up (marked done) after
+    MAX_ATTEMPTS.
+    '''
+
+    RETRY_DELAY = 600
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.ctime = 0.
+        # ctime by path
+        self.done = {}
+        # (ctime, attempts, time of the next attempt) by path
+        self.failed = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+            # Cursors written before the ctime ordering hold an mtime
+            self.ctime = state.get('ctime', state.get('mtime', 0.))
+            self.done = state['done']
+            self.failed = state.get('failed', {})
+
+    def new_files(self, directories, pattern='*.gsar', settle=60):
+        ''' Return a list of (ctime, path) of the files matching pattern in
+        the directories which are not done, ordered by ctime. Files changed
+        less than settle seconds ago may still be written, and failed files
+        waiting for a retry, are left for a later scan.
+        '''
+        now = time.time()
+        files = []
+        for directory in directories:
+            for root, dirs, names in os.walk(directory):
+                for name in fnmatch.filter(names, pattern):
+                    path = os.path.join(root, name)
+                    try:
+                        ctime = os.stat(path).st_ctime
+                    except OSError:
+                        continue
+                    if ctime >= self.ctime and now - ctime >= settle:
+                        files.append((ctime, path))
+        files.sort()
+        with self._lock:
+            # Move the watermark past the files done
+            for ctime, path in files:
+                if self.done.get(path) != ctime:
+                    break
+                self.ctime = ctime
+            self.done = dict((path, ctime) for path, ctime in
+                    self.done.items() if ctime >= self.ctime)
+            new = []
+            for ctime, path in files:
+                if ctime < self.ctime or self.done.get(path) == ctime:
+                    continue
+                if path in self.failed:
+                    if self.failed[path][0] != ctime:
+                        # Replaced since it failed
+                        del self.failed[path]
+                    elif self.failed[path][2] > now:
+                        continue
+                new.append((ctime, path))
+        return new
+
+    def mark_done(self, path, ctime):
+        with self._lock:
+            self.done[path] = ctime
+            self.failed.pop(path, None)
+            self.save()
+
+    def mark_failed(self, path, ctime):
+        ''' Schedule a retry of a file which failed. Returns True if the
+        file is given up.
+        '''
+        with self._lock:
+            attempts = 1
+            if path in self.failed and self.failed[path][0] == ctime:
+                attempts = self.failed[path][1] + 1
+            if attempts >= self.MAX_ATTEMPTS:
+                self.done[path] = ctime
+                self.failed.pop(path, None)
+            else:
+                self.failed[path] = (ctime, attempts,
+                        time.time() + self.RETRY_DELAY*2**(attempts - 1))
+            self.save()
+            return attempts >= self.MAX_ATTEMPTS
+
+    def save(self):
+        ''' Write the cursor atomically '''
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'ctime': self.ctime, 'done': self.done,
+                'failed': self.failed}, f)
+        os.rename(tmp, self.path)
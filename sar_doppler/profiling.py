@@ -0,0 +1,141 @@
+''' Profiling of the processing of single scenes
+
+A SceneProfiler runs cProfile and, where available, tracemalloc around the
+processing of each scene. The statistics of each scene can be written to a
+directory (<scene>.prof, readable with pstats or snakeviz, and
+<scene>.tracemalloc, readable with tracemalloc.Snapshot.load), and are
+aggregated over the run for a summary of the hot functions.
+'''
+import os
+import io
+import time
+import pstats
+import cProfile
+import contextlib
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+class SceneProfiler(object):
+
+    def __init__(self, directory='', memory=True, limit=25):
+        ''' Set up the profiler
+
+        Parameters
+        ----------
+        directory : str
+            Where the profiles of each scene are written. Nothing is written
+            if empty.
+        memory : bool
+            Trace memory allocations (Python 3 only)
+        limit : int
+            Number of functions and allocation sites listed in the report
+        '''
+        self.directory = directory
+        self.memory = memory and tracemalloc is not None
+        self.limit = limit
+        self.scenes = []
+        self.stats = None
+        self.allocations = {}
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @contextlib.contextmanager
+    def profile(self, uri):
+        ''' Profile the code run within the context as the scene uri '''
+        name = os.path.splitext(os.path.basename(uri))[0]
+        profiler = cProfile.Profile()
+        if self.memory:
+            tracemalloc.start()
+        t0 = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.time() - t0
+            peak = None
+            if self.memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self._add_allocations(snapshot)
+            self.scenes.append((name, elapsed, peak))
+            if self.directory:
+                profiler.dump_stats(os.path.join(self.directory,
+                    name + '.prof'))
+                if self.memory:
+                    snapshot.dump(os.path.join(self.directory,
+                        name + '.tracemalloc'))
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+
+    def _add_allocations(self, snapshot):
+        for stat in snapshot.statistics('lineno'):
+            frame = stat.traceback[0]
+            key = '%s:%d' % (frame.filename, frame.lineno)
+            self.allocations[key] = self.allocations.get(key, 0) + stat.size
+
+    def report(self):
+        ''' Return a summary of the profiled scenes, and of the hot functions
+        and allocation sites over all scenes
+        '''
+        lines = ['Profiled %d scenes' % len(self.scenes)]
+        for name, elapsed, peak in sorted(self.scenes, key=lambda s: -s[1]):
+            line = '%10.1f s  %s' % (elapsed, name)
+            if peak is not None:
+                line += '  (peak traced memory %.1f MB)' % (peak/1024.**2)
+            lines.append(line)
+        if self.stats is not None:
+            stream = io.StringIO() if str is not bytes else io.BytesIO()
+            self.stats.stream = stream
+            self.stats.sort_stats('cumulative').print_stats(self.limit)
+            lines.append(stream.getvalue())
+        if self.allocations:
+            lines.append('Largest allocation sites (MB retained at the end '
+                    'of the scenes, summed):')
+            for key, size in sorted(self.allocations.items(),
+                    key=lambda item: -item[1])[:self.limit]:
+                lines.append('%10.1f  %s' % (size/1024.**2, key))
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, stdout):
+        ''' Write the report to stdout, and to the profile directory if set '''
+        report = self.report()
+        stdout.write(report)
+        if self.directory:
+            with open(os.path.join(self.directory, 'report.txt'), 'w') as f:
+                f.write(report)
+
+@contextlib.contextmanager
+def profiled(profiler, uri):
+    ''' Profile the scene uri with the profiler, unless it is None '''
+    if profiler is None:
+        yield
+    else:
+        with profiler.profile(uri):
+            yield
+
+def command_profiler(options):
+    ''' Return a SceneProfiler set up from the --profile and --profile-dir
+    options of a management command, or None if profiling is not requested.
+    The options are removed, since the rest are passed on to the manager.
+    '''
+    profile = options.pop('profile', False)
+    directory = options.pop('profile_dir', '')
+    if not (profile or directory):
+        return None
+    return SceneProfiler(directory=directory)
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+            help='Profile the time and memory use of each scene, and report '
+            'the hot functions of the run')
+    parser.add_argument('--profile-dir', type=str, default='',
+            help='Write the profiles of each scene to this directory '
+            '(implies --profile)')
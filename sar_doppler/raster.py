@@ -0,0 +1,21 @@
+''' Windowed reading of bands of Nansat objects '''
+import numpy as np
+
+def read_lines(n, band_id, x_offset, y_offset, x_size, y_size, stride=1):
+    ''' Read a window of a band of the Nansat object n, decimated by stride,
+    without reading the full band. With a stride, only every stride-th line
+    of the window is read. Fill values are replaced by nan as in
+    Nansat.__getitem__.
+    '''
+    band = n.get_GDALRasterBand(band_id)
+    if stride == 1:
+        data = band.ReadAsArray(x_offset, y_offset, x_size, y_size)
+    else:
+        data = np.concatenate([
+            band.ReadAsArray(x_offset, y_offset + y, x_size, 1)[:, ::stride]
+            for y in range(0, y_size, stride)])
+    if data.dtype.char in np.typecodes['AllFloat']:
+        if '_FillValue' in band.GetMetadata():
+            data[data == float(band.GetMetadata()['_FillValue'])] = np.nan
+        data[np.isinf(data)] = np.nan
+    return data
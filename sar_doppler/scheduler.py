@@ -0,0 +1,195 @@
+''' Scheduling of the processing of scenes within a memory budget
+
+The peak memory of processing a scene is estimated from the dimensions of
+its largest subswath, read from the metadata without loading any pixels.
+Scenes are processed in separate worker processes, and a scene is only
+started when the sum of the estimates of the running scenes stays within the
+budget. The measured peaks are used to refine the estimates, through a
+calibration factor kept between runs.
+'''
+import os
+import json
+import pickle
+import logging
+import resource
+import threading
+import multiprocessing
+
+from django.db import connections
+from django.utils.six.moves import queue
+
+from geospaas.utils.utils import nansat_filename
+
+from nansat.nansat import Nansat
+
+from sar_doppler.cache import cache_dir
+
+# Initial bytes per pixel of the largest subswath held at the peak of the
+# processing (bands of the raw file, Doppler products, figures)
+BYTES_PER_PIXEL = 400.
+
+# Weight of a new measurement in the calibration factor
+CALIBRATION_WEIGHT = 0.3
+
+# Margin added to the calibrated estimates
+SAFETY_MARGIN = 1.2
+
+def subswath_pixels(fn, n_subswaths=5):
+    ''' Return the number of pixels of the largest subswath of the file fn '''
+    pixels = 0
+    for i in range(n_subswaths):
+        try:
+            nrows, ncols = Nansat(fn, subswath=i).shape()
+        except Exception:
+            # Missing or corrupt subswath, handled in the processing
+            continue
+        pixels = max(pixels, nrows*ncols)
+    return pixels
+
+def max_rss():
+    ''' Return the peak resident memory [bytes] of the current process '''
+    # kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+class Calibration(object):
+    ''' Persisted factor scaling BYTES_PER_PIXEL to the measured peaks '''
+
+    def __init__(self, path=''):
+        self.path = path or os.path.join(cache_dir('scheduler'),
+                'calibration.json')
+        self.factor = 1.
+        self.samples = 0
+        self._lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.factor = state['factor']
+            self.samples = state['samples']
+
+    def estimate(self, pixels):
+        ''' Return the estimated peak memory [bytes] of a scene '''
+        return SAFETY_MARGIN*self.factor*BYTES_PER_PIXEL*pixels
+
+    def update(self, pixels, peak):
+        ''' Refine the factor with the measured peak memory [bytes] of a
+        scene
+        '''
+        if pixels <= 0 or peak <= 0:
+            return
+        factor = peak/(BYTES_PER_PIXEL*pixels)
+        with self._lock:
+            if self.samples == 0:
+                self.factor = factor
+            else:
+                self.factor += CALIBRATION_WEIGHT*(factor - self.factor)
+            self.samples += 1
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'factor': self.factor, 'samples': self.samples}, f)
+            os.rename(tmp, self.path)
+
+def _process_scene(manager, uri, kwargs, results):
+    ''' Process a scene in a worker process, and put (uri, processed, error,
+    peak memory) on the results queue
+    '''
+    start = max_rss()
+    processed, error = False, None
+    try:
+        ds, processed = manager.process(uri, **kwargs)
+    except Exception as e:
+        error = e
+        try:
+            # Make sure the error can be sent to the parent
+            pickle.dumps(e)
+        except Exception:
+            error = RuntimeError(repr(e))
+    results.put((uri, processed, error, max_rss() - start))
+
+class MemoryScheduler(object):
+
+    def __init__(self, manager, budget, workers=None, calibration=None,
+            **process_kwargs):
+        ''' Set up the scheduler
+
+        Parameters
+        ----------
+        manager : DatasetManager
+            Manager whose process method is run for each scene
+        budget : int
+            Memory [bytes] available for the scenes processed at the same time
+        workers : int
+            Maximum number of scenes processed at the same time (default: the
+            number of CPUs)
+        calibration : Calibration
+            Calibration of the memory estimates (default: the persisted one)
+        process_kwargs
+            Passed on to manager.process
+        '''
+        self.manager = manager
+        self.budget = budget
+        self.workers = workers or multiprocessing.cpu_count()
+        self.calibration = calibration or Calibration()
+        self.process_kwargs = process_kwargs
+        self._results = multiprocessing.Queue()
+        # Running scenes by uri: (process, pixels, estimate)
+        self._running = {}
+
+    def run(self, uris, callback):
+        ''' Process the scenes, calling callback(uri, processed, error) as
+        each of them is done
+        '''
+        for uri in uris:
+            pixels = subswath_pixels(nansat_filename(uri),
+                    self.manager.N_SUBSWATHS)
+            estimate = self.calibration.estimate(pixels)
+            # A scene larger than the budget is processed alone
+            while self._running and (len(self._running) >= self.workers or
+                    self.used + estimate > self.budget):
+                self._wait(callback)
+            # The workers must not share the database connections
+            connections.close_all()
+            process = multiprocessing.Process(target=_process_scene,
+                    args=(self.manager, uri, self.process_kwargs,
+                        self._results))
+            process.start()
+            self._running[uri] = (process, pixels, estimate)
+        while self._running:
+            self._wait(callback)
+
+    @property
+    def used(self):
+        ''' Sum of the memory estimates of the running scenes '''
+        return sum(estimate for process, pixels, estimate in
+                self._running.values())
+
+    def _wait(self, callback):
+        ''' Wait until a running scene is done '''
+        while True:
+            try:
+                uri, processed, error, peak = self._results.get(timeout=1)
+            except queue.Empty:
+                # Workers killed before reporting, e.g. by the OOM killer
+                for uri, (process, pixels, estimate) in list(
+                        self._running.items()):
+                    if process.exitcode not in (None, 0):
+                        del self._running[uri]
+                        process.join()
+                        # The estimate was too low - the scene needed at
+                        # least the memory left to it
+                        self.calibration.update(pixels, max(2*estimate,
+                            self.budget - self.used))
+                        logging.info('%s: estimated %.0f MB, worker exited '
+                                'with code %d' % (uri, estimate/1024.**2,
+                                    process.exitcode))
+                        callback(uri, False, MemoryError(
+                            'Worker exited with code %d' % process.exitcode))
+                        return
+                continue
+            process, pixels, estimate = self._running.pop(uri)
+            process.join()
+            if error is None:
+                self.calibration.update(pixels, peak)
+                logging.info('%s: estimated %.0f MB, peak %.0f MB' % (uri,
+                    estimate/1024.**2, peak/1024.**2))
+            callback(uri, processed, error)
+            return
@@ -0,0 +1,116 @@
+''' Statistics of Doppler products over multiple acquisitions
+
+Running statistics, and the weights of the radial velocities by viewing
+geometry with their caches. Only numpy is needed, so that the module can be
+used (and tested) without the processing stack.
+'''
+import numpy as np
+
+from sar_doppler.cache import LRUCache, DiskCache, cache_dir
+
+# Assumed uncertainty of the geophysical Doppler shift [Hz]
+FDG_UNCERTAINTY = 5.
+
+def radial_velocity_uncertainty(incidence_angle, fdg_uncertainty=FDG_UNCERTAINTY):
+    ''' Return the uncertainty [m/s] of the radial surface velocity given the
+    incidence angle [degrees] and the uncertainty of the geophysical Doppler
+    shift [Hz]
+    '''
+    return np.pi*fdg_uncertainty/(112*np.sin(incidence_angle*np.pi/180.))
+
+# Precision [degrees] of the longitude where a track crosses the latitude of
+# the domain. Repeat passes on the same track cross it within about a
+# kilometre, while neighbouring tracks are tens of kilometres apart.
+TRACK_PRECISION = 0.25
+
+GEOMETRY_MEMORY_CACHE_SIZE = 256*1024**2
+GEOMETRY_DISK_CACHE_SIZE = 2*1024**3
+
+geometry_cache = LRUCache(GEOMETRY_MEMORY_CACHE_SIZE)
+_geometry_disk_cache = None
+
+# Lookups of cached_geometry_weights, and those found in the caches
+geometry_cache_stats = {'lookups': 0, 'hits': 0}
+
+def track_key(n, satpass, latitude):
+    ''' Return a key of the track of the subswath n: the pass and the
+    longitude where its middle range column crosses the latitude, rounded to
+    TRACK_PRECISION. The key does not depend on how n is cropped.
+    '''
+    nrows, ncols = n.shape()
+    lon, lat = n.transform_points([(ncols - 1)/2.]*2, [0, nrows - 1])
+    # The column is close to a straight line over a domain
+    crossing = lon[0] + (latitude - lat[0])*(lon[1] - lon[0])/(lat[1] - lat[0])
+    return (satpass, int(np.round(crossing/TRACK_PRECISION)))
+
+def geometry_weights(n, satpass):
+    ''' Return an array of the inverse variance of the radial velocity of n,
+    and of its products with the cosine and sine of the look direction
+    '''
+    # TODO: estimate the uncertainty of the Doppler shift correctly...
+    var_inv = 1./np.square(radial_velocity_uncertainty(n['incidence_angle']))
+    if satpass=='ascending':
+        angle = -n['sensor_azimuth']*np.pi/180.
+    else:
+        angle = (n['sensor_azimuth']-180.)*np.pi/180.
+    return np.array([var_inv, np.cos(angle)*var_inv, np.sin(angle)*var_inv])
+
+def cached_geometry_weights(n, satpass, key, covered):
+    ''' Return geometry_weights(n, satpass), from the memory or disk cache
+    if the weights of key were computed before, and nan where the boolean
+    array covered is False.
+
+    Scenes of the same key may cover slightly different parts of the domain.
+    The weights are recomputed if the cached ones do not cover all pixels
+    covered by n, and they are masked where n has no data.
+    '''
+    global _geometry_disk_cache
+    if _geometry_disk_cache is None:
+        _geometry_disk_cache = DiskCache(cache_dir('geometry'),
+                GEOMETRY_DISK_CACHE_SIZE)
+    geometry_cache_stats['lookups'] += 1
+    weights = geometry_cache.get(key)
+    if weights is None:
+        weights = _geometry_disk_cache.get(key)
+    if weights is None or np.any(covered & ~np.isfinite(weights[0])):
+        weights = geometry_weights(n, satpass).astype(np.float32)
+        _geometry_disk_cache.set(key, weights)
+    else:
+        geometry_cache_stats['hits'] += 1
+    geometry_cache.set(key, weights)
+    return np.where(covered, weights, np.nan)
+
+def accumulate(total, x):
+    ''' Add x to total in place, ignoring nan '''
+    total += np.where(np.isnan(x), 0., x)
+
+class RunningStats(object):
+    ''' NaN-aware running mean and standard deviation of a sequence of
+    arrays of equal shape, updated in place with Welford's algorithm. The
+    memory use does not depend on the number of arrays.
+    '''
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self._mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+
+    def add(self, x):
+        valid = np.isfinite(x)
+        x = x[valid]
+        self.count[valid] += 1
+        delta = x - self._mean[valid]
+        self._mean[valid] += delta / self.count[valid]
+        self._m2[valid] += delta * (x - self._mean[valid])
+
+    @property
+    def mean(self):
+        mean = self._mean.copy()
+        mean[self.count==0] = np.nan
+        return mean
+
+    def std(self, ddof=0):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self._m2 / (self.count - ddof))
+        std[self.count<=ddof] = np.nan
+        return std
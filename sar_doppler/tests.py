@@ -1,11 +1,39 @@
-from mock import patch, Mock, DEFAULT
+from mock import patch, Mock, MagicMock, DEFAULT
+import os
+import time
+import shutil
+import tempfile
+import datetime
+import numpy as np
 
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 from django.core.management import call_command
-from django.utils.six import StringIO
+from django.http import Http404
+from django.utils import timezone
+from django.contrib.gis.geos import WKTReader
+from django.utils.six import StringIO, BytesIO
+
+from geospaas.catalog.models import GeographicLocation
+from geospaas.viewer.models import Visualization
 
 from sar_doppler.models import Dataset
-from sar_doppler.managers import DatasetManager
+from sar_doppler.managers import DatasetManager, azimuth_blocks
+from sar_doppler.managers import _split_overlap, geometry_digest
+from sar_doppler.pipeline import ScenePipeline, ScanCursor
+from sar_doppler.stats import RunningStats, geometry_weights
+from sar_doppler.stats import cached_geometry_weights, geometry_cache
+from sar_doppler.stats import track_key
+from sar_doppler.cache import LRUCache, DiskCache
+from sar_doppler.auxdata import TimeIndex, AuxiliaryIndex
+from sar_doppler.collocation import interpolation_weight
+from sar_doppler.views import timeseries, subset
+from sar_doppler.extract import pixel_window
+from sar_doppler.raster import read_lines
+from sar_doppler.overviews import block_mean, overview_filename, write_overviews
+from sar_doppler.profiling import SceneProfiler
+from sar_doppler.scheduler import Calibration, MemoryScheduler, BYTES_PER_PIXEL
+from sar_doppler.landstore import LandDopplerStore, land_samples
+from sar_doppler.intermediates import intermediate
 
 class TestProcessingSARDoppler(TestCase):
 
@@ -32,3 +60,768 @@ class TestProcessingSARDoppler(TestCase):
         filter.assert_called()
         #exclude.assert_called_once()
         process.assert_called_once()
+
+    @patch.multiple(DatasetManager, filter=DEFAULT, render=DEFAULT)
+    def test_render_sar_doppler(self, filter, render):
+        filter.return_value.filter.return_value.distinct.return_value = [Mock()]
+        render.return_value = True
+        out = StringIO()
+        call_command('render_sar_doppler', stdout=out)
+        render.assert_called_once()
+        self.assertIn('Successfully rendered', out.getvalue())
+
+    @patch.multiple(DatasetManager, filter=DEFAULT, add_footprints=DEFAULT)
+    def test_add_sar_doppler_footprints(self, filter, add_footprints):
+        filter.return_value.filter.return_value.distinct.return_value = [
+                Mock(), Mock()]
+        add_footprints.return_value = 5
+        out = StringIO()
+        call_command('add_sar_doppler_footprints', stdout=out)
+        self.assertEqual(add_footprints.call_count, 2)
+        self.assertIn('Added 5 footprints (2/2)', out.getvalue())
+
+
+class TestRender(TestCase):
+
+    @patch.multiple('sar_doppler.managers', Nansat=DEFAULT,
+            select_product=DEFAULT, Domain=DEFAULT, nansat_filename=DEFAULT,
+            media_path=DEFAULT, Parameter=DEFAULT, DatasetParameter=DEFAULT,
+            VisualizationParameter=DEFAULT)
+    def test_render_refreshes_visualizations(self, Nansat, select_product,
+            Domain, nansat_filename, media_path, Parameter, DatasetParameter,
+            VisualizationParameter):
+        nansat_filename.return_value = '/data/RVL_ASA_WS_1.gsar'
+        media_path.return_value = '/media/RVL_ASA_WS_1'
+        Parameter.objects.get.return_value = Mock(standard_name='dca')
+        DatasetParameter.objects.get_or_create.return_value = (Mock(), True)
+        VisualizationParameter.objects.get_or_create.return_value = (Mock(),
+                True)
+        n = Nansat.return_value
+        n.get_corners.return_value = (np.array([0., 1.]), np.array([0., 1.]))
+        ds = Mock()
+        ds.dataseturi_set.filter.return_value = [
+                Mock(uri='file://localhost/data/RVL_ASA_WS_1subswath0.nc')]
+        count = Visualization.objects.count()
+        n.get_border_wkt.return_value = 'POLYGON((0 0,1 0,1 1,0 1,0 0))'
+        self.assertTrue(Dataset.objects.render(ds))
+        rendered = Visualization.objects.count()
+        self.assertGreater(rendered, count)
+        # The products have other corners than the gsar file
+        n.get_border_wkt.return_value = 'POLYGON((0 0,2 0,2 2,0 2,0 0))'
+        self.assertTrue(Dataset.objects.render(ds))
+        self.assertEqual(Visualization.objects.count(), rendered)
+        for vv in Visualization.objects.all():
+            self.assertTrue(vv.geographic_location.geometry.equals(
+                WKTReader().read('POLYGON((0 0,2 0,2 2,0 2,0 0))')))
+
+
+class TestAzimuthBlocks(TestCase):
+
+    def test_blocks_cover_all_lines(self):
+        self.assertEqual(list(azimuth_blocks(10, 4)), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(list(azimuth_blocks(4, 4)), [(0, 4)])
+
+    def test_invalid_block_size(self):
+        with self.assertRaises(ValueError):
+            list(azimuth_blocks(10, 0))
+
+
+class PixelLocalDoppler(object):
+    """ Doppler stand-in computing the products per pixel """
+
+    def __init__(self, dca):
+        self.dca = dca
+        self.vrt = Mock()
+        self.bands = []
+
+    def shape(self):
+        return self.dca.shape
+
+    def crop(self, x0, y0, xsize, ysize):
+        self.dca = self.dca[y0:y0 + ysize, x0:x0 + xsize]
+
+    def anomaly(self):
+        return self.dca - np.arange(self.dca.shape[1])
+
+    def geophysical_doppler_shift(self):
+        return -2*self.anomaly()
+
+    def add_band(self, array, parameters):
+        self.bands.append(np.array(array))
+
+
+class TestAddDopplerProductsBlockwise(TestCase):
+
+    def test_blocks_equal_full_computation(self):
+        dca = np.random.rand(10, 6).astype(np.float32)
+        full, blockwise = PixelLocalDoppler(dca), PixelLocalDoppler(dca)
+        Dataset.objects.add_doppler_products(full)
+        Dataset.objects.add_doppler_products_blockwise(blockwise, 4)
+        for expected, band in zip(full.bands, blockwise.bands):
+            np.testing.assert_allclose(band, expected, rtol=1e-5)
+        # The subswath itself is not cropped
+        self.assertEqual(blockwise.shape(), (10, 6))
+        self.assertEqual(blockwise.vrt.copy.call_count, 3)
+
+
+class TestScenePipeline(TestCase):
+
+    def test_pipeline_runs_all_stages(self):
+        written = []
+        def process(uri, writer=None, **kwargs):
+            for i in range(2):
+                writer(lambda i: written.append((uri, i)) or True, i)
+            return uri, True
+        manager = Mock(process=Mock(side_effect=process))
+        done = []
+        pipeline = ScenePipeline(manager,
+                callback=lambda uri, ds, processed, error: done.append(
+                    (uri, processed, error)))
+        for uri in ['file://localhost/a.gsar', 'file://localhost/b.gsar']:
+            pipeline.submit(uri)
+        pipeline.close()
+        pipeline.join()
+        self.assertEqual(len(written), 4)
+        self.assertEqual(done, [('file://localhost/a.gsar', True, None),
+            ('file://localhost/b.gsar', True, None)])
+
+    def test_pipeline_reports_errors(self):
+        manager = Mock(process=Mock(side_effect=ValueError('corrupt')))
+        done = []
+        pipeline = ScenePipeline(manager,
+                callback=lambda uri, ds, processed, error: done.append(error))
+        pipeline.submit('file://localhost/a.gsar')
+        pipeline.close()
+        pipeline.join()
+        self.assertIsInstance(done[0], ValueError)
+
+    def test_pipeline_with_several_compute_workers(self):
+        manager = Mock(process=Mock(side_effect=lambda uri, **kwargs: (uri, True)))
+        done = []
+        pipeline = ScenePipeline(manager, compute_workers=3,
+                callback=lambda uri, ds, processed, error: done.append(uri))
+        uris = ['file://localhost/%d.gsar' % i for i in range(10)]
+        for uri in uris:
+            pipeline.submit(uri)
+        pipeline.close()
+        pipeline.join()
+        self.assertEqual(sorted(done), sorted(uris))
+
+
+class TestScanCursor(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'cursor.json')
+        for name in ['a.gsar', 'b.gsar', 'c.txt']:
+            open(os.path.join(self.directory, name), 'w').close()
+            time.sleep(0.01)
+
+    def new_files(self, cursor):
+        return cursor.new_files([self.directory], settle=0)
+
+    def test_new_files_are_returned_until_done(self):
+        cursor = ScanCursor(self.path)
+        files = self.new_files(cursor)
+        self.assertEqual([os.path.basename(p) for c, p in files],
+                ['a.gsar', 'b.gsar'])
+        cursor.mark_done(*reversed(files[0]))
+        # The position is kept between runs
+        cursor = ScanCursor(self.path)
+        self.assertEqual(self.new_files(cursor), files[1:])
+        self.assertEqual(cursor.ctime, files[0][0])
+
+    def test_done_files_behind_the_watermark_are_not_returned(self):
+        cursor = ScanCursor(self.path)
+        files = self.new_files(cursor)
+        cursor.mark_done(*reversed(files[1]))
+        cursor.mark_done(*reversed(files[0]))
+        self.assertEqual(self.new_files(cursor), [])
+
+    def test_late_files_with_old_mtime_are_returned(self):
+        cursor = ScanCursor(self.path)
+        for ctime, path in self.new_files(cursor):
+            cursor.mark_done(path, ctime)
+        self.assertEqual(self.new_files(cursor), [])
+        # Copied into the archive with its modification time kept
+        fn = os.path.join(self.directory, 'old.gsar')
+        open(fn, 'w').close()
+        os.utime(fn, (time.time() - 1e6, time.time() - 1e6))
+        self.assertEqual([p for c, p in self.new_files(cursor)], [fn])
+        # Replaced at the same path
+        cursor.mark_done(fn, os.stat(fn).st_ctime)
+        self.assertEqual(self.new_files(cursor), [])
+        time.sleep(0.01)
+        with open(fn, 'w') as f:
+            f.write('new')
+        self.assertEqual([p for c, p in self.new_files(cursor)], [fn])
+
+    def test_failed_files_are_retried_later_and_given_up(self):
+        cursor = ScanCursor(self.path)
+        files = self.new_files(cursor)
+        cursor.mark_done(*reversed(files[0]))
+        self.assertFalse(cursor.mark_failed(*reversed(files[1])))
+        cursor = ScanCursor(self.path)
+        self.assertEqual(self.new_files(cursor), [])
+        for i in range(ScanCursor.MAX_ATTEMPTS - 2):
+            self.assertFalse(cursor.mark_failed(*reversed(files[1])))
+        self.assertTrue(cursor.mark_failed(*reversed(files[1])))
+        self.assertEqual(self.new_files(cursor), [])
+        self.assertEqual(cursor.ctime, files[1][0])
+
+    def test_recently_changed_files_are_left(self):
+        cursor = ScanCursor(self.path)
+        self.assertEqual(cursor.new_files([self.directory], settle=1000), [])
+
+
+class TestRunningStats(TestCase):
+
+    def test_nan_aware_mean_and_std(self):
+        stack = np.array([[[1., np.nan], [2., np.nan]],
+                          [[3., np.nan], [np.nan, np.nan]],
+                          [[8., np.nan], [4., np.nan]]])
+        stats = RunningStats((2, 2))
+        for x in stack:
+            stats.add(x)
+        np.testing.assert_allclose(stats.mean, np.nanmean(stack, axis=0))
+        np.testing.assert_allclose(stats.std(), np.nanstd(stack, axis=0))
+        np.testing.assert_array_equal(stats.count, [[3, 0], [2, 0]])
+
+
+class TestLRUCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_bytes=2*8*10)
+        cache.set('a', np.zeros(10))
+        cache.set('b', np.zeros(10))
+        cache.get('a')
+        cache.set('c', np.zeros(10))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.size, 2*8*10)
+
+
+class TestTimeIndex(TestCase):
+
+    def setUp(self):
+        t0 = datetime.datetime(2010, 1, 1)
+        self.times = [t0 + datetime.timedelta(hours=6*i) for i in range(4)]
+        self.index = TimeIndex([(t, i) for i, t in enumerate(self.times)][::-1])
+
+    def test_nearest(self):
+        t = self.times[1] + datetime.timedelta(hours=2)
+        self.assertEqual(self.index.nearest(t), (self.times[1], 1))
+        self.assertIsNone(self.index.nearest(t,
+            tolerance=datetime.timedelta(hours=1)))
+
+    def test_bracket(self):
+        t = self.times[1] + datetime.timedelta(hours=2)
+        self.assertEqual(self.index.bracket(t),
+                ((self.times[1], 1), (self.times[2], 2)))
+        self.assertIsNone(self.index.bracket(
+            self.times[0] - datetime.timedelta(hours=1)))
+
+    def test_interpolation_weight(self):
+        t = self.times[1] + datetime.timedelta(hours=2)
+        self.assertAlmostEqual(interpolation_weight(t, self.times[1],
+            self.times[2]), 1/3.)
+
+
+class TestAuxiliaryIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name in ['current/u_2010-01-02.nc', 'current/u_2010-01-01.nc',
+                'wind/w20100101.grb']:
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.index = AuxiliaryIndex([
+            {'directory': os.path.join(self.directory, 'current'),
+                'pattern': r'(?P<variable>\w+?)_(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})\.nc$'},
+            {'directory': os.path.join(self.directory, 'wind'),
+                'pattern': r'w(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})\.grb$',
+                'variables': ['eastward_wind'], 'mapper': 'ncep'},
+        ])
+
+    def test_sources_are_scanned_on_lookup(self):
+        t = datetime.datetime(2010, 1, 1, 20, tzinfo=timezone.utc)
+        ftime, path, mapper = self.index.find('u', t)
+        self.assertEqual(os.path.basename(path), 'u_2010-01-02.nc')
+        # Only the source with variables in the file names is scanned
+        self.assertEqual(self.index._scanned, set([0]))
+        ftime, path, mapper = self.index.find('eastward_wind', t)
+        self.assertEqual((os.path.basename(path), mapper), ('w20100101.grb',
+            'ncep'))
+        self.assertIsNone(self.index.find('northward_wind', t))
+
+
+class TestMergeSubswaths(TestCase):
+
+    def test_overlap_is_split_at_middle(self):
+        near = dict(zip(('lon', 'lat'),
+            np.meshgrid(np.arange(10)*.1, np.arange(4)*.1)))
+        far = dict(zip(('lon', 'lat'),
+            np.meshgrid(.7 + np.arange(10)*.1, np.arange(6)*.1)))
+        near_cols, far_cols = _split_overlap(near, far, slice(None),
+                slice(None))
+        self.assertEqual(near_cols, slice(None, 9))
+        self.assertEqual(far_cols, slice(2, None))
+
+    @patch('sar_doppler.managers.product_pixel_spacing', return_value=250.)
+    def test_input_is_decimated(self, spacing):
+        bands = {'valid_doppler': np.ones((8, 6)),
+                'dca': np.arange(48.).reshape(8, 6)}
+        n = Mock(shape=Mock(return_value=(8, 6)),
+                transform_points=lambda cols, rows: (cols, rows),
+                __getitem__=lambda self, band: bands.get(band, bands['dca']))
+        part = Dataset.objects.merge_input(n)
+        # Blocks of 4 x 4 pixels
+        self.assertEqual(part['lon'].shape, (2, 2))
+        np.testing.assert_allclose(part['lon'][0], [1.5, 5.])
+        np.testing.assert_allclose(part['lat'][:, 0], [1.5, 5.5])
+        np.testing.assert_allclose(part['dca'][0], [10.5, 13.5])
+        np.testing.assert_array_equal(part['valid_doppler'], 1)
+
+
+class TestReadLines(TestCase):
+
+    def test_only_stride_lines_are_read(self):
+        data = np.arange(70.).reshape(10, 7)
+        band = Mock(GetMetadata=Mock(return_value={}),
+                ReadAsArray=lambda x0, y0, xs, ys: data[y0:y0+ys, x0:x0+xs])
+        n = Mock(get_GDALRasterBand=Mock(return_value=band))
+        np.testing.assert_array_equal(read_lines(n, 'dca', 1, 2, 5, 7, 3),
+                data[2:9, 1:6][::3, ::3])
+        np.testing.assert_array_equal(read_lines(n, 'dca', 1, 2, 5, 7),
+                data[2:9, 1:6])
+
+
+class TestPixelWindow(TestCase):
+
+    def setUp(self):
+        # 100 lines x 50 columns, lon 0..4.9, lat 0..9.9
+        self.n = Mock(shape=Mock(return_value=(100, 50)))
+        def grids(stepSize=1):
+            lat, lon = np.mgrid[0:100:stepSize, 0:50:stepSize]*0.1
+            return lon, lat
+        self.n.get_geolocation_grids.side_effect = grids
+        self.n.transform_points.return_value = ([np.nan], [np.nan])
+
+    def test_bbox_partly_outside(self):
+        # Corners outside the product do not matter
+        self.assertEqual(pixel_window(self.n, None, None, (-10, 2, 1, 50)),
+                (0, 19, 12, 81))
+
+    def test_bbox_outside(self):
+        self.assertIsNone(pixel_window(self.n, None, None, (10, 2, 11, 3)))
+
+
+class TestTimeseriesView(TestCase):
+
+    @patch('sar_doppler.views.extract_timeseries')
+    def test_timeseries(self, extract):
+        extract.return_value = [{'fdg': np.nan, 'Ur': 0.5, 'subswath': 2}]
+        request = RequestFactory().get('/timeseries/', {'lon': 20, 'lat': -35,
+            'start': '2010-01-01', 'end': '2010-02-01'})
+        response = timeseries(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'"fdg": null', response.content)
+
+    def test_timeseries_bad_request(self):
+        request = RequestFactory().get('/timeseries/', {'lon': 20})
+        self.assertEqual(timeseries(request).status_code, 400)
+
+
+class TestSubsetView(TestCase):
+
+    @patch('sar_doppler.views.iter_subset')
+    @patch('sar_doppler.views.subswath_products')
+    @patch.object(DatasetManager, 'get')
+    def test_subset_is_streamed_as_npy(self, get, products, iter_subset):
+        data = np.arange(12, dtype=np.float32).reshape(3, 4)
+        products.return_value = [(1, 'file://localhost/tmp/subswath1.nc')]
+        iter_subset.return_value = (data.shape, data.dtype,
+                iter([data[:2], data[2:]]))
+        request = RequestFactory().get('/subset/', {'dataset': 1,
+            'subswath': 1, 'variable': 'fdg', 'stride': 2})
+        response = subset(request)
+        content = BytesIO(b''.join(response.streaming_content))
+        np.testing.assert_array_equal(np.load(content), data)
+        self.assertEqual(iter_subset.call_args[1]['stride'], 2)
+
+    @patch('sar_doppler.views.subswath_products')
+    @patch.object(DatasetManager, 'get')
+    def test_missing_subswath(self, get, products):
+        products.return_value = []
+        request = RequestFactory().get('/subset/', {'dataset': 1,
+            'subswath': 1, 'variable': 'fdg'})
+        with self.assertRaises(Http404):
+            subset(request)
+
+    @patch('sar_doppler.extract.product_handles')
+    @patch('sar_doppler.views.subswath_products')
+    @patch.object(DatasetManager, 'get')
+    def test_unknown_variable(self, get, products, handles):
+        products.return_value = [(1, 'file://localhost/tmp/subswath1.nc')]
+        handles.get.return_value = (MagicMock(), Mock(has_band=Mock(
+            return_value=False)))
+        request = RequestFactory().get('/subset/', {'dataset': 1,
+            'subswath': 1, 'variable': 'nothing'})
+        self.assertEqual(subset(request).status_code, 400)
+
+    @patch('sar_doppler.views.subswath_products')
+    @patch.object(DatasetManager, 'get')
+    def test_missing_product(self, get, products):
+        products.return_value = [(1, 'file://localhost/tmp/missing/subswath1.nc')]
+        request = RequestFactory().get('/subset/', {'dataset': 1,
+            'subswath': 1, 'variable': 'fdg'})
+        with self.assertRaises(Http404):
+            subset(request)
+
+
+class TestGeometryDigest(TestCase):
+
+    def test_digest_of_equal_geometries(self):
+        g1 = WKTReader().read('POLYGON((0 0,1 0,1 1,0 1,0 0))')
+        g2 = WKTReader().read('POLYGON((1 1,0 1,0 0,1 0,1 1))')
+        g3 = WKTReader().read('POLYGON((0 0,2 0,2 2,0 2,0 0))')
+        self.assertEqual(geometry_digest(g1), geometry_digest(g2))
+        self.assertNotEqual(geometry_digest(g1), geometry_digest(g3))
+
+    def test_location_is_created_once(self):
+        g1 = WKTReader().read('POLYGON((0 0,1 0,1 1,0 1,0 0))')
+        g2 = WKTReader().read('POLYGON((1 1,0 1,0 0,1 0,1 1))')
+        count = GeographicLocation.objects.count()
+        location = Dataset.objects.get_or_create_location(g1)
+        self.assertEqual(Dataset.objects.get_or_create_location(g2), location)
+        self.assertEqual(GeographicLocation.objects.count(), count + 1)
+
+    def test_location_without_digest_is_found(self):
+        g1 = WKTReader().read('POLYGON((0 0,1 0,1 1,0 1,0 0))')
+        g2 = WKTReader().read('POLYGON((1 1,0 1,0 0,1 0,1 1))')
+        # As created by the geospaas ingestor
+        location = GeographicLocation.objects.create(geometry=g1)
+        count = GeographicLocation.objects.count()
+        self.assertEqual(Dataset.objects.get_or_create_location(g2), location)
+        self.assertEqual(GeographicLocation.objects.count(), count)
+
+    def test_digest_follows_changed_geometry(self):
+        g1 = WKTReader().read('POLYGON((0 0,1 0,1 1,0 1,0 0))')
+        g2 = WKTReader().read('POLYGON((0 0,2 0,2 2,0 2,0 0))')
+        location = Dataset.objects.get_or_create_location(g1)
+        location.geometry = g2
+        location.save()
+        Dataset.objects.update_location_digest(location)
+        count = GeographicLocation.objects.count()
+        self.assertEqual(Dataset.objects.get_or_create_location(g2), location)
+        self.assertNotEqual(Dataset.objects.get_or_create_location(g1),
+                location)
+        self.assertEqual(GeographicLocation.objects.count(), count + 1)
+
+
+class TestOverviews(TestCase):
+
+    def test_block_mean_ignores_nan(self):
+        x = np.arange(15, dtype=float).reshape(3, 5)
+        x[0, 0] = np.nan
+        np.testing.assert_allclose(block_mean(x, 2),
+                [[4., 5., 6.5], [10.5, 12.5, 14.]])
+
+    def write_overviews(self, bands, block_size):
+        nrows, ncols = bands['dca'].shape
+        n = Mock(shape=Mock(return_value=(nrows, ncols)),
+                has_band=lambda band: band in bands,
+                get_metadata=Mock(return_value={'pixel_spacing': '250.0'}))
+        n.transform_points.side_effect = lambda cols, rows: (cols, rows)
+        written = {}
+        def nansat(domain=None):
+            ov = Mock()
+            ov.add_band.side_effect = lambda array, parameters: \
+                    written.setdefault(ov, {}).update(
+                            {parameters['name']: np.array(array)})
+            def export(filename):
+                written[filename] = written.pop(ov)
+                written[filename]['metadata'] = dict(call[0] for call in
+                        ov.set_metadata.call_args_list if len(call[0]) == 2)
+            ov.export.side_effect = export
+            return ov
+        def read_lines(n, band, x_offset, y_offset, x_size, y_size):
+            return bands[band][y_offset:y_offset+y_size,
+                    x_offset:x_offset+x_size].copy()
+        with patch.multiple('sar_doppler.overviews', Nansat=nansat,
+                Domain=DEFAULT, read_lines=read_lines):
+            write_overviews(n, '/p/RVLsubswath1.nc', block_size)
+        return written
+
+    def test_write_overviews_blockwise(self):
+        rng = np.random.RandomState(0)
+        bands = {'dca': rng.rand(37, 17).astype(np.float32),
+                'valid_doppler': (rng.rand(37, 17) > 0.3).astype(np.uint8)}
+        bands['dca'][rng.rand(37, 17) > 0.7] = np.nan
+        full = self.write_overviews(bands, None)
+        blockwise = self.write_overviews(bands, 10)
+        for factor in (2, 4, 8):
+            fn = overview_filename('/p/RVLsubswath1.nc', factor)
+            # The coarser levels are built from the finer ones
+            np.testing.assert_allclose(full[fn]['dca'],
+                    block_mean(bands['dca'], factor), rtol=1e-5)
+            np.testing.assert_allclose(blockwise[fn]['dca'], full[fn]['dca'],
+                    rtol=1e-5)
+            np.testing.assert_array_equal(blockwise[fn]['valid_doppler'],
+                    full[fn]['valid_doppler'])
+            self.assertEqual(full[fn]['metadata'], {
+                'overview_factor': str(factor),
+                'pixel_spacing': '%.1f' % (250.*factor)})
+
+    def test_overview_filename(self):
+        self.assertEqual(overview_filename('/p/RVLsubswath1.nc', 4),
+                '/p/RVLsubswath1_x4.nc')
+
+
+class TestSceneProfiler(TestCase):
+
+    def test_profiles_are_written_and_aggregated(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profiler = SceneProfiler(directory=directory)
+        for uri in ['file://localhost/a.gsar', 'file://localhost/b.gsar']:
+            with profiler.profile(uri):
+                sorted(range(1000), reverse=True)
+        self.assertEqual([s[0] for s in profiler.scenes], ['a', 'b'])
+        self.assertIn('a.prof', os.listdir(directory))
+        out = StringIO()
+        profiler.write_report(out)
+        self.assertIn('Profiled 2 scenes', out.getvalue())
+        self.assertIn('report.txt', os.listdir(directory))
+
+
+class TestCalibration(TestCase):
+
+    def test_estimates_follow_measured_peaks(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'calibration.json')
+        calibration = Calibration(path)
+        calibration.update(1000, 2*BYTES_PER_PIXEL*1000)
+        self.assertEqual(calibration.factor, 2)
+        # Kept between runs
+        calibration = Calibration(path)
+        self.assertGreater(calibration.estimate(1000), 2*BYTES_PER_PIXEL*1000)
+        calibration.update(1000, 3*BYTES_PER_PIXEL*1000)
+        self.assertTrue(2 < calibration.factor < 3)
+
+    def test_killed_worker_raises_the_estimates(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        calibration = Calibration(os.path.join(directory, 'calibration.json'))
+        calibration.update(1000, BYTES_PER_PIXEL*1000)
+        estimate = calibration.estimate(1000)
+        scheduler = MemoryScheduler(Mock(), budget=10*estimate,
+                calibration=calibration)
+        process = Mock(exitcode=-9)
+        scheduler._running['a.gsar'] = (process, 1000, estimate)
+        callback = Mock()
+        scheduler._wait(callback)
+        process.join.assert_called_once_with()
+        self.assertIsInstance(callback.call_args[0][2], MemoryError)
+        self.assertGreater(calibration.estimate(1000), estimate)
+
+
+class TestLandDopplerStore(TestCase):
+
+    def test_samples_are_read_by_key_and_time(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = LandDopplerStore(root)
+        t0 = datetime.datetime(2010, 1, 1, tzinfo=timezone.utc)
+        for day in range(3):
+            store.append('ENVISAT', 'ASAR', 2, 'VV', 'ascending',
+                    t0 + datetime.timedelta(days=day), 'product%d' % day,
+                    {'dca': np.arange(day + 1), 'view_angle': np.ones(day + 1),
+                        'std_dca': np.ones(day + 1)})
+        # Appending a product again has no effect
+        store.append('ENVISAT', 'ASAR', 2, 'VV', 'ascending', t0, 'product0',
+                {'dca': np.arange(5), 'view_angle': np.ones(5),
+                    'std_dca': np.ones(5)})
+        samples = store.read('ENVISAT', 'ASAR', 2, 'VV', 'ascending',
+                t0 + datetime.timedelta(days=1), t0 + datetime.timedelta(days=5))
+        np.testing.assert_array_equal(samples['dca'], [0, 1, 0, 1, 2])
+        self.assertEqual(samples['dca'].dtype, np.float32)
+        samples = store.read('ENVISAT', 'ASAR', 2, 'VV', 'descending', t0,
+                t0 + datetime.timedelta(days=5))
+        self.assertEqual(len(samples['dca']), 0)
+        self.assertEqual(store.sources(), {'product0': None, 'product1': None,
+            'product2': None})
+
+    def test_reprocessed_product_replaces_its_samples(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = LandDopplerStore(root)
+        t0 = datetime.datetime(2010, 1, 1, tzinfo=timezone.utc)
+        for day in range(2):
+            store.append('ENVISAT', 'ASAR', 2, 'VV', 'ascending',
+                    t0 + datetime.timedelta(days=day), 'product%d' % day,
+                    {'dca': np.zeros(2) + day, 'view_angle': np.ones(2),
+                        'std_dca': np.ones(2)}, mtime=100.)
+        # Same version
+        store.append('ENVISAT', 'ASAR', 2, 'VV', 'ascending', t0, 'product0',
+                {'dca': np.arange(5), 'view_angle': np.ones(5),
+                    'std_dca': np.ones(5)}, mtime=100.)
+        # Reprocessed
+        store.append('ENVISAT', 'ASAR', 2, 'VV', 'ascending', t0, 'product0',
+                {'dca': [5., 6., 7.], 'view_angle': np.ones(3),
+                    'std_dca': np.ones(3)}, mtime=200.)
+        samples = store.read('ENVISAT', 'ASAR', 2, 'VV', 'ascending', t0,
+                t0 + datetime.timedelta(days=5))
+        np.testing.assert_array_equal(np.sort(samples['dca']),
+                [1, 1, 5, 6, 7])
+        self.assertEqual(store.sources(), {'product0': 200.,
+            'product1': 100.})
+
+    def test_land_samples_are_read_blockwise(self):
+        rng = np.random.RandomState(0)
+        land = np.zeros((10, 4), dtype=np.uint8)
+        land[[1, 2, 7]] = rng.rand(3, 4) > 0.5
+        bands = {'valid_land_doppler': land, 'dca': rng.rand(10, 4),
+                1: rng.rand(10, 4), 2: rng.rand(10, 4)}
+        n = Mock(shape=Mock(return_value=(10, 4)),
+                get_band_number=Mock(side_effect=lambda query:
+                    1 if query['standard_name'] == 'sensor_view_angle' else 2),
+                transform_points=Mock(return_value=([0, 0], [1, 0])))
+        read = []
+        def read_lines(n, band, x_offset, y_offset, x_size, y_size):
+            read.append((band, y_offset, y_size))
+            return bands[band][y_offset:y_offset+y_size].copy()
+        with patch('sar_doppler.landstore.read_lines', read_lines):
+            polarization, orbit_pass, columns = land_samples(n, block_size=3)
+        self.assertEqual(orbit_pass, 'ascending')
+        np.testing.assert_allclose(columns['dca'], bands['dca'][land == 1])
+        np.testing.assert_allclose(columns['std_dca'], bands[2][land == 1])
+        # Blocks without land are not read
+        self.assertNotIn(('dca', 3, 3), read)
+
+
+class TestGeometryWeights(TestCase):
+
+    def setUp(self):
+        self.n = {'incidence_angle': np.array([[30., 40.]]),
+                'sensor_azimuth': np.array([[90., 100.]])}
+
+    def test_weights(self):
+        var_inv, cos_var_inv, sin_var_inv = geometry_weights(self.n,
+                'ascending')
+        sigma = np.pi*5./(112*np.sin(np.radians([[30., 40.]])))
+        np.testing.assert_allclose(var_inv, 1./sigma**2)
+        np.testing.assert_allclose(sin_var_inv, -var_inv, rtol=0.02)
+        var_inv, cos_var_inv, sin_var_inv = geometry_weights(self.n,
+                'descending')
+        np.testing.assert_allclose(cos_var_inv, [[0, var_inv[0, 1]*np.cos(
+            np.radians(-80.))]], atol=1e-9)
+
+    def test_weights_are_cached(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = patch('sar_doppler.stats._geometry_disk_cache',
+                DiskCache(directory, 1024**2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        key = ('test', datetime.datetime.now())
+        covered = np.array([[True, True]])
+        weights = cached_geometry_weights(self.n, 'ascending', key, covered)
+        n = Mock(__getitem__=Mock(side_effect=KeyError))
+        np.testing.assert_array_equal(cached_geometry_weights(n,
+            'ascending', key, covered), weights)
+        # From disk
+        geometry_cache.pop(key)
+        np.testing.assert_array_equal(cached_geometry_weights(n,
+            'ascending', key, covered), weights)
+        # Masked where the scene has no data
+        masked = cached_geometry_weights(n, 'ascending', key,
+                np.array([[True, False]]))
+        np.testing.assert_array_equal(masked[:, 0, 0], weights[:, 0, 0])
+        self.assertTrue(np.isnan(masked[:, 0, 1]).all())
+
+    def test_weights_are_recomputed_for_larger_coverage(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = patch('sar_doppler.stats._geometry_disk_cache',
+                DiskCache(directory, 1024**2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        key = ('test', datetime.datetime.now())
+        n = {'incidence_angle': np.array([[30., np.nan]]),
+                'sensor_azimuth': np.array([[90., np.nan]])}
+        cached_geometry_weights(n, 'ascending', key,
+                np.array([[True, False]]))
+        weights = cached_geometry_weights(self.n, 'ascending', key,
+                np.array([[True, True]]))
+        np.testing.assert_allclose(weights,
+                geometry_weights(self.n, 'ascending'), rtol=1e-6)
+
+    def test_track_key_does_not_depend_on_the_crop(self):
+        def subswath(lon0, rows):
+            # A track along the meridian lon0, with 10 lines per degree
+            return Mock(shape=Mock(return_value=(len(rows), 5)),
+                    transform_points=lambda cols, lines: (
+                        [lon0 + 0.01*(rows[0] + line) for line in lines],
+                        [-40 + (rows[0] + line)/10. for line in lines]))
+        key = track_key(subswath(20., range(0, 100)), 'ascending', -35.3)
+        self.assertEqual(track_key(subswath(20.02, range(30, 60)),
+            'ascending', -35.3), key)
+        self.assertNotEqual(track_key(subswath(20.8, range(0, 100)),
+            'ascending', -35.3), key)
+
+
+class TestIntermediates(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.source = os.path.join(directory, 'RVL_ASA_WS_1.gsar')
+        self.product = os.path.join(directory, 'RVL_ASA_WS_1subswath2.nc')
+        open(self.source, 'w').close()
+        patcher = patch('sar_doppler.intermediates.subswath_product_filename',
+                return_value=self.product)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('sar_doppler.intermediates.read_lines')
+    @patch('sar_doppler.intermediates.product_handles')
+    def test_read_from_up_to_date_product(self, product_handles, read_lines):
+        open(self.product, 'w').close()
+        n = Mock(shape=Mock(return_value=(4, 3)))
+        product_handles.get.return_value = (Mock(), n)
+        read_lines.return_value = np.ones((4, 3))
+        compute = Mock()
+        data = intermediate(self.source, 2, 'anomaly', compute)
+        np.testing.assert_array_equal(data, np.ones((4, 3)))
+        read_lines.assert_called_once_with(n, 'dca', 0, 0, 3, 4)
+        self.assertFalse(compute.called)
+
+    @patch('sar_doppler.intermediates.read_lines')
+    @patch('sar_doppler.intermediates.product_handles')
+    def test_read_from_product_if_source_is_missing(self, product_handles,
+            read_lines):
+        open(self.product, 'w').close()
+        os.remove(self.source)
+        product_handles.get.return_value = (Mock(),
+                Mock(shape=Mock(return_value=(4, 3))))
+        read_lines.return_value = np.ones((4, 3))
+        compute = Mock()
+        data = intermediate(self.source, 2, 'valid_land_doppler', compute)
+        np.testing.assert_array_equal(data, np.ones((4, 3)))
+        self.assertFalse(compute.called)
+
+    def test_recomputed_when_stale(self):
+        open(self.product, 'w').close()
+        os.utime(self.product, (0, 0))
+        compute = Mock(return_value=np.zeros((4, 3)))
+        for i in range(2):
+            data = intermediate(self.source, 2, 'fdg', compute)
+        np.testing.assert_array_equal(data, np.zeros((4, 3)))
+        # Kept in memory
+        self.assertEqual(compute.call_count, 1)
@@ -0,0 +1,10 @@
+from django.conf.urls import url
+
+from sar_doppler import views
+
+app_name = 'sar_doppler'
+
+urlpatterns = [
+    url(r'^timeseries/$', views.timeseries, name='timeseries'),
+    url(r'^subset/$', views.subset, name='subset'),
+]
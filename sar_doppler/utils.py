@@ -2,6 +2,7 @@
 Utility functions for processing Doppler from multiple SAR acquisitions
 '''
 import os, datetime, warnings
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import optimize
@@ -22,6 +23,16 @@ from django.core.management import call_command
 from geospaas.utils import nansat_filename, media_path, product_path
 from geospaas.catalog.models import Dataset, DatasetURI
 
+from sar_doppler.managers import cropped_blocks, disk_backed_array, vrt_copy
+from sar_doppler.auxdata import aux_cache, target_key
+from sar_doppler.extract import intersecting_products, pixel_window
+from sar_doppler.overviews import select_product, domain_resolution
+from sar_doppler.landstore import land_store, add_samples, orbit_pass
+from sar_doppler.landstore import source_mtime
+from sar_doppler.intermediates import intermediate, source_filename
+from sar_doppler.stats import RunningStats, track_key, cached_geometry_weights
+from sar_doppler.stats import accumulate, geometry_cache_stats
+
 # Start as script
 t0 = datetime.datetime(2010,1,4,0,0,0, tzinfo=timezone.utc)
 t1 = datetime.datetime(2010,1,5,0,0,0, tzinfo=timezone.utc)
@@ -29,8 +40,25 @@ t1 = datetime.datetime(2010,1,5,0,0,0, tzinfo=timezone.utc)
 def rb_model_func(x, a, b, c, d, e, f):
     return a + b*x + c*x**2 + d*x**3 + e*np.sin(x) + f*np.cos(x)
 
+def bin_lookup(values, bins, bin_values):
+    ''' Return an array of the shape of values, where each element is set to
+    the value of the bin it falls into (nan outside the bins)
+    '''
+    out = np.empty(values.shape)
+    out[:] = np.nan
+    for ii in range(len(bins)-1):
+        out[(values>=bins[ii]) & (values<=bins[ii+1])] = bin_values[ii]
+    return out
+
 def update_geophysical_doppler(dopplerFile, t0, t1, swath, sensor='ASAR',
-        platform='ENVISAT'):
+        platform='ENVISAT', block_size=None):
+    ''' Correct the geophysical Doppler shift of dopplerFile with the land
+    Doppler of the given swath between t0 and t1.
+
+    If block_size is given, the corrected Doppler shift and the current are
+    computed over azimuth blocks of block_size lines and kept in disk backed
+    arrays, so that the peak memory does not depend on the scene size.
+    '''
 
     dop2correct = Doppler(dopplerFile)
     bandnum = dop2correct.get_band_number({
@@ -38,13 +66,9 @@ def update_geophysical_doppler(dopplerFile, t0, t1, swath, sensor='ASAR',
             'surface_backwards_doppler_centroid_frequency_shift_of_radar_wave'
     })
     polarization = dop2correct.get_metadata(band_id=bandnum, key='polarization')
-    lon,lat = dop2correct.get_geolocation_grids()
-    indmidaz = lat.shape[0]/2
-    indmidra = lat.shape[1]/2
-    if lat[indmidaz,indmidra]>lat[0,indmidra]:
-        use_pass = 'ascending'
-    else:
-        use_pass = 'descending'
+    # The anomaly and land mask were stored when the subswath was processed
+    source = source_filename(dop2correct)
+    use_pass = orbit_pass(dop2correct)
 
     # Get datasets
     DS = Dataset.objects.filter(source__platform__short_name=platform,
@@ -55,141 +79,29 @@ def update_geophysical_doppler(dopplerFile, t0, t1, swath, sensor='ASAR',
             time_coverage_start__lt = t1
         )
 
-    swath_files = []
+    # Land Doppler samples of the products not yet in the land store, e.g.
+    # processed before it was introduced, or changed since they were added
+    store = land_store()
+    stored = store.sources()
     for dd in dopDS:
         try:
-            fn = dd.dataseturi_set.get(
+            uri = dd.dataseturi_set.get(
                     uri__endswith='subswath%s.nc' %swath).uri
         except DatasetURI.DoesNotExist:
             continue
-        n = Doppler(fn)
-        try:
-            dca = n.anomaly(pol=polarization)
-        except OptionError: # wrong polarization..
-            continue
-        lon,lat=n.get_geolocation_grids()
-        indmidaz = lat.shape[0]/2
-        indmidra = lat.shape[1]/2
-        if lat[indmidaz,indmidra]>lat[0,indmidra]:
-            orbit_pass = 'ascending'
-        else:
-            orbit_pass = 'descending'
-        if use_pass==orbit_pass:
-            swath_files.append(fn)
-
-    valid_land = np.array([])
-    valid = np.array([])
-    for ff in swath_files:
-        n = Nansat(ff)
-        view_bandnum = n.get_band_number({
-            'standard_name': 'sensor_view_angle'
-        })
-        std_bandnum = n.get_band_number({
-            'standard_name': \
-                'standard_deviation_of_surface_backwards_doppler_centroid_frequency_shift_of_radar_wave',
-        })
-        pol = n.get_metadata(band_id=std_bandnum, key='polarization')
-
-        # For checking when antenna pattern changes
-        if valid.shape==(0,):
-            valid = n['valid_doppler']
-            dca0 = n['dca']
-            dca0[n['valid_doppler']==0] = np.nan
-            dca0[n['valid_sea_doppler']==1] = dca0[n['valid_sea_doppler']==1] - \
-                    n['fww'][n['valid_sea_doppler']==1]
-            view_angle0 = n[view_bandnum]
-        else:
-            validn = n['valid_doppler']
-            dca0n = n['dca']
-            dca0n[n['valid_doppler']==0] = np.nan
-            dca0n[n['valid_sea_doppler']==1] = dca0n[n['valid_sea_doppler']==1] - \
-                    n['fww'][n['valid_sea_doppler']==1]
-            view_angle0n = n[view_bandnum]
-            if not validn.shape==valid.shape:
-                if validn.shape[1] > valid.shape[1]:
-                    valid = np.resize(valid, (valid.shape[0], validn.shape[1]))
-                    dca0 = np.resize(dca0, (dca0.shape[0], dca0n.shape[1]))
-                    view_angle0 = np.resize(view_angle0,
-                        (view_angle0.shape[0], view_angle0n.shape[1]))
-                else:
-                    validn = np.resize(validn, (validn.shape[0],
-                        valid.shape[1]))
-                    dca0n = np.resize(dca0n, (dca0n.shape[0], dca0.shape[1]))
-                    view_angle0n = np.resize(view_angle0n,
-                        (view_angle0n.shape[0], view_angle0.shape[1]))
-            valid = np.concatenate((valid, validn))
-            dca0 = np.concatenate((dca0, dca0n))
-            view_angle0 = np.concatenate((view_angle0, view_angle0n))
-
-
-        if valid_land.shape==(0,):
-            valid_land = n['valid_land_doppler'][n['valid_land_doppler'].any(axis=1)]
-            dca = n['dca'][n['valid_land_doppler'].any(axis=1)]
-            view_angle = n[view_bandnum][n['valid_land_doppler'].any(axis=1)]
-            std_dca = n[std_bandnum][n['valid_land_doppler'].any(axis=1)]
-        else:
-            vn = n['valid_land_doppler'][n['valid_land_doppler'].any(axis=1)]
-            dcan = n['dca'][n['valid_land_doppler'].any(axis=1)]
-            view_angle_n = n[view_bandnum][n['valid_land_doppler'].any(axis=1)]
-            std_dca_n = n[std_bandnum][n['valid_land_doppler'].any(axis=1)]
-            if not vn.shape==valid_land.shape:
-                # Resize arrays - just for visual inspection. Actual interpolation
-                # is view angle vs doppler anomaly
-                if vn.shape[1] > valid_land.shape[1]:
-                    valid_land = np.resize(valid_land, (valid_land.shape[0],
-                        vn.shape[1]))
-                    dca = np.resize(dca, (dca.shape[0],
-                        vn.shape[1]))
-                    view_angle = np.resize(view_angle, (view_angle.shape[0],
-                        vn.shape[1]))
-                    std_dca = np.resize(std_dca, (std_dca.shape[0],
-                        vn.shape[1]))
-                if vn.shape[1] < valid_land.shape[1]:
-                    vn = np.resize(vn, (vn.shape[0], valid_land.shape[1]))
-                    dcan = np.resize(dcan, (dcan.shape[0], valid_land.shape[1]))
-                    view_angle_n = np.resize(view_angle_n, (view_angle_n.shape[0], valid_land.shape[1]))
-                    std_dca_n = np.resize(std_dca_n, (std_dca_n.shape[0], valid_land.shape[1]))
-            valid_land = np.concatenate((valid_land, vn))
-            dca = np.concatenate((dca, dcan))
-            view_angle = np.concatenate((view_angle, view_angle_n))
-            std_dca = np.concatenate((std_dca, std_dca_n))
-
-    view_angle0 = view_angle0.flatten()
-    dca0 = dca0.flatten()
-    view_angle0 = np.delete(view_angle0, np.where(np.isnan(dca0)))
-    dca0 = np.delete(dca0, np.where(np.isnan(dca0)))
-    ind = np.argsort(view_angle0)
-    view_angle0 = view_angle0[ind]
-    dca0 = dca0[ind]
-
-    # Set dca, view_angle and std_dca to nan where not land
-    dca[valid_land==0] = np.nan
-    std_dca[valid_land==0] = np.nan
-    view_angle[valid_land==0] = np.nan
-
-    dca = dca.flatten()
-    std_dca = std_dca.flatten()
-    view_angle = view_angle.flatten()
-
-    dca = np.delete(dca, np.where(np.isnan(dca)))
-    std_dca = np.delete(std_dca, np.where(np.isnan(std_dca)))
-    view_angle = np.delete(view_angle, np.where(np.isnan(view_angle)))
-
-    ind = np.argsort(view_angle)
-    view_angle = view_angle[ind]
-    dca = dca[ind]
-    std_dca = std_dca[ind]
+        if stored.get(uri) != source_mtime(uri):
+            add_samples(dd, Nansat(nansat_filename(uri)), uri, store)
+
+    samples = store.read(platform, sensor, swath, polarization, use_pass, t0,
+            t1)
+    ind = np.argsort(samples['view_angle'])
+    view_angle = samples['view_angle'][ind]
+    dca = samples['dca'][ind]
+    std_dca = samples['std_dca'][ind]
 
     freqLims = [-200,200]
 
     # Show this in presentation:
-    plt.subplot(2,1,1)
-    count, anglebins, dcabins, im = plt.hist2d(view_angle0, dca0, 100, cmin=1,
-            range=[[np.min(view_angle), np.max(view_angle)], freqLims])
-    plt.colorbar()
-    plt.title('Wind Doppler subtracted')
-
-    plt.subplot(2,1,2)
     count, anglebins, dcabins, im = plt.hist2d(view_angle, dca, 100, cmin=1,
             range=[[np.min(view_angle), np.max(view_angle)], freqLims])
     plt.colorbar()
@@ -228,23 +140,21 @@ def update_geophysical_doppler(dopplerFile, t0, t1, swath, sensor='ASAR',
     rb4interp = np.array(rb4interp)
     std_rb4interp = np.array(std_rb4interp)
 
-    van = dop2correct['sensor_view']
-    rbfull = van.copy()
-    rbfull[:,:] = np.nan
-    # Is there a more efficient method than looping?
+    # Median land Doppler in each view angle bin
+    rb_bins = [np.median(dca[(view_angle>=anglebins[ii]) &
+                             (view_angle<=anglebins[ii+1])])
+               for ii in range(len(anglebins)-1)]
+
     import time
     start_time = time.time()
-    for ii in range(len(anglebins)-1):
-        vaii0 = anglebins[ii]
-        vaii1 = anglebins[ii+1]
-        rbfull[(van>=vaii0) & (van<=vaii1)] = \
-                np.median(dca[(view_angle>=vaii0) & (view_angle<=vaii1)])
-    #print("--- %s seconds ---" % (time.time() - start_time))
-    plt.plot(np.mean(van, axis=0), np.mean(rbfull, axis=0), '.')
-    #plt.plot(anglebins_vec, dcabins_vec, '.')
-    #plt.show()
-    plt.close()
-
+    if not block_size:
+        van = dop2correct['sensor_view']
+        rbfull = bin_lookup(van, anglebins, rb_bins)
+        #print("--- %s seconds ---" % (time.time() - start_time))
+        plt.plot(np.mean(van, axis=0), np.mean(rbfull, axis=0), '.')
+        #plt.plot(anglebins_vec, dcabins_vec, '.')
+        #plt.show()
+        plt.close()
 
     #guess = [.1,.1,.1,.1,.1,.1]
     #[a,b,c,d,e,f], params_cov = optimize.curve_fit(rb_model_func,
@@ -274,7 +184,24 @@ def update_geophysical_doppler(dopplerFile, t0, t1, swath, sensor='ASAR',
     #plt.show()
 
     band_name = 'fdg_corrected'
-    fdg = dop2correct.anomaly() - rbfull
+    if block_size:
+        nlines, npixels = dop2correct.shape()
+        fdg = disk_backed_array((nlines, npixels))
+        current = disk_backed_array((nlines, npixels))
+        for y0, y1, block in cropped_blocks(dop2correct, block_size):
+            rb = bin_lookup(block['sensor_view'], anglebins, rb_bins)
+            fdg[y0:y1] = intermediate(source, swath, 'anomaly', block.anomaly,
+                    window=(0, y0, npixels, y1 - y0)) - rb
+            current[y0:y1] = -(np.pi*(fdg[y0:y1] - block['fww']) / 112 /
+                np.sin(block['incidence_angle']*np.pi/180))
+            del block
+        fdg.flush()
+        current.flush()
+    else:
+        fdg = intermediate(source, swath, 'anomaly',
+                dop2correct.anomaly) - rbfull
+        current = -(np.pi*(fdg - dop2correct['fww']) / 112 /
+                    np.sin(dop2correct['incidence_angle']*np.pi/180))
     #plt.imshow(fdg, vmin=-60, vmax=60)
     #plt.colorbar()
     #plt.show()
@@ -285,20 +212,20 @@ def update_geophysical_doppler(dopplerFile, t0, t1, swath, sensor='ASAR',
         }
     )
 
-    current = -(np.pi*(fdg - dop2correct['fww']) / 112 /
-                np.sin(dop2correct['incidence_angle']*np.pi/180))
     dop2correct.add_band(array=current,
             parameters={'name': 'current', 'units': 'm/s', 'minmax': '-2 2'}
         )
 
+    land_mask = intermediate(source, swath, 'valid_land_doppler',
+            lambda: dop2correct['valid_land_doppler'])
     land = np.array([])
     # add land data for accuracy calculation
     if land.shape==(0,):
-        land = dop2correct['valid_land_doppler'][dop2correct['valid_land_doppler'].any(axis=1)]
-        land_fdg = fdg[dop2correct['valid_land_doppler'].any(axis=1)]
+        land = land_mask[land_mask.any(axis=1)]
+        land_fdg = fdg[land_mask.any(axis=1)]
     else:
-        landn = dop2correct['valid_land_doppler'][dop2correct['valid_land_doppler'].any(axis=1)]
-        land_fdgn = fdg[dop2correct['valid_land_doppler'].any(axis=1)]
+        landn = land_mask[land_mask.any(axis=1)]
+        land_fdgn = fdg[land_mask.any(axis=1)]
         if not landn.shape==land.shape:
             if landn.shape[1] > land.shape[1]:
                 land = np.resize(land, (land.shape[0], landn.shape[1]))
@@ -383,9 +310,11 @@ def calc_mean_doppler(datetime_start=timezone.datetime(2010,1,1,
     tzinfo=timezone.utc), domain=Domain(NSR().wkt, 
         '-te 10 -44 40 -30 -tr 0.05 0.05')):
     geometry = WKTReader().read(domain.get_border_wkt(nPoints=1000))
-    ds = Dataset.objects.filter(entry_title__contains='Doppler',
-            time_coverage_start__range=[datetime_start, datetime_end],
-            geographic_location__geometry__intersects=geometry)
+    # Only subswaths intersecting the domain are opened
+    products = intersecting_products(geometry, datetime_start, datetime_end)
+    dlon, dlat = domain.get_corners()
+    bbox = [dlon.min(), dlat.min(), dlon.max(), dlat.max()]
+    domain_key = target_key(domain)
     Va = np.zeros(domain.shape())
     Vd = np.zeros(domain.shape())
     ca = np.zeros(domain.shape())
@@ -394,60 +323,50 @@ def calc_mean_doppler(datetime_start=timezone.datetime(2010,1,1,
     sd = np.zeros(domain.shape())
     sum_var_inv_a = np.zeros(domain.shape())
     sum_var_inv_d = np.zeros(domain.shape())
-    for dd in ds:
-        uris = dd.dataseturi_set.filter(uri__endswith='nc')
-        for uri in uris:
-            dop = Doppler(uri.uri)
-            # Consider skipping swath 1 and possibly 2...
-            dop.reproject(domain)
-            # TODO: HARDCODING - MUST BE IMPROVED
-            satpass = dop.get_metadata(key='Originating file').split('/')[6]
-            if satpass=='ascending':
-                try:
-                    v_ai = dop['Ur']
-                    v_ai[np.abs(v_ai)>3] = np.nan
-                except:
-                    # subswath doesn't cover the given domain
-                    continue
-                # uncertainty:
-                # 5 Hz - TODO: estimate this correctly...
-                sigma_ai = -np.pi*np.ones(dop.shape())*5./(112*np.sin(dop['incidence_angle']*np.pi/180.)) 
-                alpha_i = -dop['sensor_azimuth']*np.pi/180.
-                Va = np.nansum(np.append(np.expand_dims(Va, 2),
-                    np.expand_dims(v_ai/np.square(sigma_ai), 2), axis=2),
-                    axis=2)
-                ca = np.nansum(np.append(np.expand_dims(ca, 2),
-                    np.expand_dims(np.cos(alpha_i)/np.square(sigma_ai), 2),
-                    axis=2), axis=2)
-                sa = np.nansum(np.append(np.expand_dims(sa, 2),
-                    np.expand_dims(np.sin(alpha_i)/np.square(sigma_ai), 2),
-                    axis=2), axis=2)
-                sum_var_inv_a =np.nansum(np.append(np.expand_dims(sum_var_inv_a, 2),
-                    np.expand_dims(1./np.square(sigma_ai), 2), axis=2),
-                    axis=2)
-            else:
-                try:
-                    v_dj = -dop['Ur']
-                    v_dj[np.abs(v_dj)>3] = np.nan
-                except:
-                    # subswath doesn't cover the given domain
-                    continue
-                # 5 Hz - TODO: estimate this correctly...
-                sigma_dj = -np.pi*np.ones(dop.shape())*5./(112*np.sin(dop['incidence_angle']*np.pi/180.)) 
-                delta_j = (dop['sensor_azimuth']-180.)*np.pi/180.
-                Vd = np.nansum(np.append(np.expand_dims(Vd, 2),
-                    np.expand_dims(v_dj/np.square(sigma_dj), 2), axis=2),
-                    axis=2)
-                cd = np.nansum(np.append(np.expand_dims(cd, 2),
-                    np.expand_dims(np.cos(delta_j)/np.square(sigma_dj), 2),
-                    axis=2), axis=2)
-                sd = np.nansum(np.append(np.expand_dims(sd, 2),
-                    np.expand_dims(np.sin(delta_j)/np.square(sigma_dj), 2),
-                    axis=2), axis=2)
-                sum_var_inv_d = np.nansum(np.append(
-                    np.expand_dims(sum_var_inv_d, 2), np.expand_dims(
-                        1./np.square(sigma_ai), 2), axis=2), axis=2)
+    # Read the coarsest overview levels that resolve the domain
+    resolution = domain_resolution(domain)
+    for dd, subswath, uri in products:
+        fn = select_product(nansat_filename(uri), resolution)
+        dop = Doppler(fn)
+        # Crop to the part covering the domain before reprojecting. The
+        # subswath intersects the domain, so it is reprojected uncropped if
+        # no window is found.
+        window = pixel_window(dop, None, None, bbox, margin=2)
+        if window is not None and window != (0, 0, dop.shape()[1],
+                dop.shape()[0]):
+            dop.crop(*window)
+        # TODO: HARDCODING - MUST BE IMPROVED
+        satpass = dop.get_metadata(key='Originating file').split('/')[6]
+        # Subswaths on the same track share the weights on the domain. The
+        # subswath and overview level are given by the end of the filename.
+        key = (track_key(dop, satpass, dlat.mean()),
+                os.path.basename(fn).rsplit('subswath', 1)[-1], domain_key)
+        # Consider skipping swath 1 and possibly 2...
+        dop.reproject(domain)
+        try:
+            v = dop['Ur']
+        except:
+            # subswath doesn't cover the given domain
+            continue
+        if satpass!='ascending':
+            v = -v
+        covered = np.isfinite(v)
+        v[np.abs(v)>3] = np.nan
+        var_inv, cos_var_inv, sin_var_inv = cached_geometry_weights(dop,
+                satpass, key, covered)
+        if satpass=='ascending':
+            accumulate(Va, v*var_inv)
+            accumulate(ca, cos_var_inv)
+            accumulate(sa, sin_var_inv)
+            accumulate(sum_var_inv_a, var_inv)
+        else:
+            accumulate(Vd, v*var_inv)
+            accumulate(cd, cos_var_inv)
+            accumulate(sd, sin_var_inv)
+            accumulate(sum_var_inv_d, var_inv)
 
+    print('Geometry weights of %(hits)d of %(lookups)d subswaths were cached'
+            % geometry_cache_stats)
     u = (Va*sd + Vd*sa)/(sa*cd + sd*ca)
     v = (Va*cd - Vd*ca)/(sa*cd + sd*ca)
     sigma_u = np.sqrt(np.square(sd)*sum_var_inv_a +
@@ -481,43 +400,73 @@ def reprocess_failed():
             print 'Reprocessing %s'%uri.uri
             call_command('ingest_sar_doppler', uri.uri, '--reprocess', stdout=out)
 
+def read_gc_geostrophic(dt, domain, key=None):
+    ''' Return the eastward GlobCurrent geostrophic current of the day dt
+    on the given domain, or None if there is no data. key is the target_key
+    of the domain, computed if not given.
+    '''
+    # The daily files were exported from
+    # http://tds0.ifremer.fr/thredds/dodsC/CLS-L4-CURGEO_0M-ALT_OI_025-V02.0_FULL_TIME_SERIE
+    # with, e.g.,
+    #n = Nansat(
+    #    fn, date='%d-%02d-%02d'%(dt.year, dt.month, dt.day),
+    #    bands=['eastward_geostrophic_current_velocity'])
+    #n.export(expFn)
+    # and are read through the auxiliary data cache
+    u = aux_cache().get('eastward_geostrophic_current_velocity', dt, domain,
+            tolerance=timezone.timedelta(hours=12), key=key)
+    if u is None:
+        warnings.warn('No GlobCurrent data for %s' % dt.date())
+        return None
+    if np.sum(np.isnan(u))==u.size:
+        return None
+    return u
+
 def mean_gc_geostrophic(datetime_start=timezone.datetime(2010,1,1,
     tzinfo=timezone.utc), datetime_end=timezone.datetime(2010,2,1,
     tzinfo=timezone.utc), domain=Domain(NSR().wkt, 
-        '-te 10 -44 40 -30 -tr 0.05 0.05')):
+        '-te 10 -44 40 -30 -tr 0.05 0.05'), workers=4):
+    ''' Mean and standard deviation of the eastward GlobCurrent geostrophic
+    current between datetime_start and datetime_end (inclusive).
+
+    The daily files are read by a pool of workers and reduced one day at a
+    time, so the memory use does not depend on the length of the period.
+    '''
     #gc_datasets = Dataset.objects.filter(entry_title__contains='globcurrent',
     #                time_coverage_start__range=[datetime_start,
     #                datetime_end])
-    shapeD = domain.shape()
-    U = np.zeros((shapeD[0], shapeD[1], 1))
-    fn = 'http://tds0.ifremer.fr/thredds/dodsC/CLS-L4-CURGEO_0M-ALT_OI_025-V02.0_FULL_TIME_SERIE'
+    dates = []
     dt = datetime_start
     while dt <= datetime_end:
-        expFn = '/vagrant/shared/test_data/globcurrent/eastward_geostrophic_current_velocity_%d-%02d-%02d.nc'%(dt.year, dt.month, dt.day)
-        #n = Nansat(
-        #    fn, date='%d-%02d-%02d'%(dt.year, dt.month, dt.day),
-        #    bands=['eastward_geostrophic_current_velocity'])
-        #n.export(expFn)
-        n = Nansat(expFn, mapper='generic')
-        n.reproject(domain, addmask=False)
-        u = n['eastward_geostrophic_current_velocity']
-        # OK:
-        #plt.imshow(u)
-        #plt.colorbar()
-        #plt.show()
-        if np.sum(np.isnan(u))==u.size:
-            continue
-        else:
-            U = np.append(U, np.expand_dims(u, axis=2), axis=2)
+        dates.append(dt)
         dt = dt + timezone.timedelta(days=1)
-    meanU = np.nanmean(U, axis=2)
+
+    stats = RunningStats(domain.shape())
+    key = target_key(domain)
+    # GDAL datasets can not be used from several threads at the same time,
+    # so the days read at the same time use their own copy of the domain
+    domains = [vrt_copy(domain) for i in range(workers)]
+    pool = ThreadPool(workers)
+    try:
+        # Read one day per worker at a time to keep the memory use bounded
+        for i in range(0, len(dates), workers):
+            for u in pool.map(lambda args: read_gc_geostrophic(*args),
+                    [(dt, d, key) for dt, d in zip(dates[i:i+workers],
+                        domains)]):
+                # Days without data are skipped
+                if u is not None:
+                    stats.add(u)
+    finally:
+        pool.close()
+        pool.join()
+    meanU = stats.mean
+    stdU = stats.std()
     nu = Nansat(array=meanU, domain=domain)
     nmap=Nansatmap(nu, resolution='h')
     nmap.pcolormesh(nu[1], vmin=-1.5, vmax=1.5, cmap='jet') #bwr
     nmap.add_colorbar()
     nmap.draw_continents()
     nmap.fig.savefig('/vagrant/shared/u_gc.png', bbox_inches='tight')
-    #stdU = np.nanstd(U, axis=2)
     ##plt.figure(figsize=(15,10))
     #plt.figure()
     #plt.subplot(1,2,1)
@@ -528,4 +477,4 @@ def mean_gc_geostrophic(datetime_start=timezone.datetime(2010,1,1,
     #plt.colorbar()
     #plt.show()
     ##plt.savefig('/vagrant/shared/globcurrent_mean_geostrophic_u.png')
-    
+    return meanU, stdU
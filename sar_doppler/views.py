@@ -1,3 +1,95 @@
-from django.shortcuts import render
+from io import BytesIO
 
-# Create your views here.
+import numpy as np
+from dateutil.parser import parse
+
+from django.http import JsonResponse, HttpResponseBadRequest, Http404
+from django.http import StreamingHttpResponse
+
+from geospaas.utils.utils import nansat_filename
+
+from sar_doppler.models import Dataset
+from sar_doppler.extract import extract_timeseries, subswath_products
+from sar_doppler.extract import iter_subset
+
+def _json_value(value):
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def timeseries(request):
+    ''' Return the time series of Doppler products at a point (lon, lat) or
+    in a bbox (west,south,east,north) between start and end as json
+    '''
+    try:
+        start = parse(request.GET['start'])
+        end = parse(request.GET['end'])
+        if 'bbox' in request.GET:
+            bbox = [float(v) for v in request.GET['bbox'].split(',')]
+            if len(bbox) != 4:
+                raise ValueError('bbox must be west,south,east,north')
+            lon, lat = (bbox[0] + bbox[2])/2., (bbox[1] + bbox[3])/2.
+        else:
+            bbox = None
+            lon, lat = float(request.GET['lon']), float(request.GET['lat'])
+    except (KeyError, ValueError) as e:
+        return HttpResponseBadRequest('Invalid query: %s' % e)
+    series = extract_timeseries(lon, lat, start, end, bbox=bbox)
+    return JsonResponse({'timeseries': [
+        dict((key, _json_value(value)) for key, value in values.items())
+        for values in series]})
+
+def subset(request):
+    ''' Stream a subset of a variable of an exported subswath product as a
+    .npy file. Query parameters: dataset (id), subswath, variable, and
+    optionally bbox (west,south,east,north) and stride.
+    '''
+    try:
+        ds_id = int(request.GET['dataset'])
+        subswath = int(request.GET['subswath'])
+        variable = request.GET['variable']
+        stride = int(request.GET.get('stride', 1))
+        if stride < 1:
+            raise ValueError('stride must be positive')
+        bbox = None
+        if 'bbox' in request.GET:
+            bbox = [float(v) for v in request.GET['bbox'].split(',')]
+            if len(bbox) != 4:
+                raise ValueError('bbox must be west,south,east,north')
+    except (KeyError, ValueError) as e:
+        return HttpResponseBadRequest('Invalid query: %s' % e)
+    try:
+        ds = Dataset.objects.get(id=ds_id)
+    except Dataset.DoesNotExist:
+        raise Http404('No dataset %d' % ds_id)
+    uris = dict(subswath_products(ds))
+    if subswath not in uris:
+        raise Http404('No product of subswath %d' % subswath)
+    try:
+        shape, dtype, chunks = iter_subset(nansat_filename(uris[subswath]),
+                variable, bbox=bbox, stride=stride)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    except (IOError, OSError):
+        # Registered, but removed from the archive
+        raise Http404('Product of subswath %d not found' % subswath)
+
+    def content():
+        header = BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': shape})
+        yield header.getvalue()
+        for chunk in chunks:
+            yield np.ascontiguousarray(chunk).tobytes()
+
+    response = StreamingHttpResponse(content(),
+            content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="%s_%d_%s.npy"' % (
+            ds_id, subswath, variable)
+    return response